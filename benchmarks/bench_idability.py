@@ -0,0 +1,194 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from benchmarks.synthetic import make_visits
+from src.idability import *
+
+"""
+Benchmarks of the idability encode/decode hot paths on synthetic tables of increasing size.
+Every (size, step) runs in its own process so that peak RSS belongs to that step (and the inputs it needs).
+
+Example:
+    python -m benchmarks.bench_idability --sizes 100 1000 5000 --output bench_results.json
+"""
+
+STEPS = ["load_sfv", "load_sfv_cached", "flip_sfv", "rank_by_rarity", "rank_by_abundgap",
+         "encode_all", "encode_all_jaccard", "decode_all"]
+DEFAULT_SIZES = [100, 1000, 5000, 20000, 50000]
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process in MB, None where the resource module is missing
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def step_function(step: str, visit1: str, visit2: str, settings: dict):
+    """
+    Prepares the inputs of one step (not timed) and returns the function to time
+    """
+    detect, nondetect = settings["abund_detect"], settings["abund_nondetect"]
+    if step == "load_sfv":
+        return lambda: load_sfv(visit1, nondetect, cache=False)
+    if step == "load_sfv_cached":
+        load_table(visit1)  # make sure the .npz sidecar exists
+        return lambda: load_sfv(visit1, nondetect)
+
+    sfv = load_sfv(visit1, nondetect)
+    if step == "flip_sfv":
+        return lambda: flip_sfv(sfv)
+    if step in ("rank_by_rarity", "rank_by_abundgap"):
+        rank_function = {"rank_by_rarity": rank_by_rarity, "rank_by_abundgap": rank_by_abundgap}[step]
+        fsv = flip_sfv(sfv)
+        reduced = reduce_sfv(sfv, cutoff=detect)
+        return lambda: rank_function(reduced, fsv, nondetect)
+    if step in ("encode_all", "encode_all_jaccard"):
+        similarity_cutoff = settings["similarity_cutoff"] if step == "encode_all_jaccard" else None
+        return lambda: encode_all(sfv, detect, nondetect, similarity_cutoff, settings["min_code_size"],
+                                  ranking=settings["ranking"], engine=settings["engine"],
+                                  jaccard_index=settings["jaccard_index"], jobs=settings["jobs"])
+    if step == "decode_all":
+        sample_codes = encode_all(sfv, detect, nondetect, settings["similarity_cutoff"], settings["min_code_size"],
+                                  ranking=settings["ranking"], engine=settings["engine"],
+                                  jaccard_index=settings["jaccard_index"], jobs=settings["jobs"])
+        eval_sfv = load_sfv(visit2, nondetect)
+        return lambda: decode_all(eval_sfv, sample_codes, detect)
+    raise ValueError(f"Unknown step {step}")
+
+
+def run_step(step: str, visit1: str, visit2: str, settings: dict) -> dict:
+    """
+    Runs one step settings["repeat"] times in this process
+    :return: dict with the fastest wall time and the peak RSS
+    """
+    # idability reports progress on stdout, which is reserved for the result here
+    with contextlib.redirect_stdout(sys.stderr):
+        function = step_function(step, visit1, visit2, settings)
+        seconds = []
+        for _ in range(settings["repeat"]):
+            start = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - start)
+    return {"seconds": min(seconds), "all_seconds": seconds, "peak_rss_mb": peak_rss_mb()}
+
+
+def run_step_process(step: str, visit1: str, visit2: str, settings: dict) -> dict:
+    """
+    Runs one step in a fresh python process
+    :return: result of run_step, or a status of timeout/error
+    """
+    command = [sys.executable, "-m", "benchmarks.bench_idability", "--child", step, visit1, visit2,
+               "--settings", json.dumps(settings)]
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 timeout=settings["timeout"], universal_newlines=True)
+    except subprocess.TimeoutExpired:
+        return {"status": "timeout"}
+    if process.returncode != 0:
+        return {"status": "error", "error": process.stderr.strip().splitlines()[-1:]}
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result["status"] = "ok"
+    return result
+
+
+def table_counts(path: str, settings: dict) -> dict:
+    """
+    Shape of a synthetic table
+    """
+    table = load_table(path)
+    return {"n_features": len(table.features), "n_samples": len(table.samples),
+            "nnz": int(np.count_nonzero(table.data > settings["abund_nondetect"]))}
+
+
+def run_benchmarks(sizes: list, steps: list, settings: dict, output_dir: str) -> list:
+    """
+    Runs every step for every number of samples
+    :return: list of result dicts
+    """
+    results = []
+    for n_samples in sizes:
+        visit1, visit2 = make_visits(output_dir, n_samples, settings["n_features"], sparsity=settings["sparsity"],
+                                     sigma=settings["sigma"], seed=settings["seed"])
+        counts = table_counts(visit1, settings)
+        for step in steps:
+            result = {"step": step}
+            result.update(counts)
+            result.update(run_step_process(step, visit1, visit2, settings))
+            results.append(result)
+            print(f"{n_samples:>7} samples  {step:<20} {result['status']:<8}"
+                  f"{result.get('seconds', float('nan')):>10.3f} s {result.get('peak_rss_mb') or float('nan'):>10.1f} MB")
+    return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmarks idability on synthetic tables")
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="numbers of samples")
+    parser.add_argument("--steps", nargs="+", choices=STEPS, default=STEPS, help="steps to time")
+    parser.add_argument("--features", type=int, default=1000, help="number of features")
+    parser.add_argument("--sparsity", type=float, default=0.97, help="fraction of zero abundances")
+    parser.add_argument("--sigma", type=float, default=2.0, help="standard deviation of the log-normal abundances")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic tables")
+    parser.add_argument("--abund_detect", type=float, default=c_relab_detect)
+    parser.add_argument("--abund_nondetect", type=float, default=c_relab_detect * c_nondetect_multiplier)
+    parser.add_argument("--similarity_cutoff", type=float, default=c_max_jaccard)
+    parser.add_argument("--min_code_size", type=int, default=c_min_code_size)
+    parser.add_argument("--ranking", choices=["rarity", "abundance_gap"], default="rarity")
+    parser.add_argument("--engine", choices=c_engines, default="sets")
+    parser.add_argument("--jaccard_index", choices=c_jaccard_indexes, default="exact")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1, help="runs per step, the fastest is reported")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds before a step is given up")
+    parser.add_argument("--data_dir", default=os.path.join("benchmarks", "data"),
+                        help="folder for the synthetic tables")
+    parser.add_argument("--output", default="bench_results.json", help="json file for the results")
+    parser.add_argument("--child", nargs=3, metavar=("STEP", "VISIT1", "VISIT2"), help=argparse.SUPPRESS)
+    parser.add_argument("--settings", help=argparse.SUPPRESS)
+    return parser
+
+
+def main(input_args=None):
+    args = get_parser().parse_args(input_args)
+    if args.child:
+        print(json.dumps(run_step(*args.child, json.loads(args.settings))))
+        return
+
+    settings = {key: getattr(args, key) for key in
+                ["features", "sparsity", "sigma", "seed", "abund_detect", "abund_nondetect", "similarity_cutoff",
+                 "min_code_size", "ranking", "engine", "jaccard_index", "jobs", "repeat", "timeout"]}
+    settings["n_features"] = settings.pop("features")
+    results = run_benchmarks(args.sizes, args.steps, settings, args.data_dir)
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": settings,
+        "results": results,
+    }
+    with open(args.output, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print("wrote benchmark results to:", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+
+"""
+Synthetic PCL tables that look like the processed_data tables: sparse relative abundances with a
+log-normal distribution and full taxonomy lineages as feature names
+"""
+
+RANKS = ["Phylum", "Class", "Order", "Family", "Genus"]
+
+
+def lineage_names(n_features: int, branching: int = 4) -> list:
+    """
+    Creates feature names like Bacteria;Phylum1;Class5;Order21;Family86;Genus345;
+    :param n_features: number of features (genera)
+    :param branching: number of children per taxon, used to derive the parent of every rank
+    :return: list of lineage strings
+    """
+    names = []
+    for feature in range(n_features):
+        taxa = []
+        for depth, rank in enumerate(RANKS):
+            taxa.append(f"{rank}{feature // branching ** (len(RANKS) - 1 - depth)}")
+        names.append(";".join(["Bacteria"] + taxa) + ";")
+    return names
+
+
+def synthetic_abundances(n_samples: int, n_features: int, sparsity: float = 0.97, sigma: float = 2.0,
+                         rng: np.random.RandomState = None) -> np.ndarray:
+    """
+    Creates a features x samples matrix of relative abundances (columns sum to 1)
+    :param sparsity: fraction of zero entries
+    :param sigma: standard deviation of the log-normal abundances
+    """
+    rng = np.random.RandomState(0) if rng is None else rng
+    # feature prevalence varies a lot between taxa, like in the real tables
+    prevalence = rng.beta(0.3, 0.3 * sparsity / (1 - sparsity), size=n_features)
+    present = rng.random_sample((n_features, n_samples)) < prevalence[:, None]
+    # make sure every sample has at least one feature
+    present[rng.randint(0, n_features, size=n_samples), np.arange(n_samples)] = True
+    values = np.where(present, rng.lognormal(0.0, sigma, size=(n_features, n_samples)), 0.0)
+    return values / values.sum(axis=0, keepdims=True)
+
+
+def next_visit(values: np.ndarray, dropout: float = 0.2, noise: float = 0.5, turnover: float = 0.005,
+               rng: np.random.RandomState = None) -> np.ndarray:
+    """
+    Creates a later visit of the same samples: some features are lost, some are gained
+    and abundances change by a log-normal factor
+    """
+    rng = np.random.RandomState(1) if rng is None else rng
+    kept = (values > 0) & (rng.random_sample(values.shape) >= dropout)
+    gained = rng.random_sample(values.shape) < turnover
+    later = np.where(kept, values * rng.lognormal(0.0, noise, size=values.shape), 0.0)
+    later = np.where(gained & ~kept, rng.lognormal(np.log(values[values > 0].mean()), noise, size=values.shape),
+                     later)
+    totals = later.sum(axis=0, keepdims=True)
+    return np.divide(later, totals, out=np.zeros_like(later), where=totals > 0)
+
+
+def write_pcl(path: str, values: np.ndarray, features: list, samples: list) -> None:
+    """
+    Saves a features x samples matrix in PCL format
+    """
+    with open(path, "w") as fh:
+        fh.write("\t".join(["subject_id"] + samples) + "\n")
+        for feature, row in zip(features, values):
+            fh.write(feature + "\t" + "\t".join(repr(value) for value in row.tolist()) + "\n")
+
+
+def make_visits(output_dir: str, n_samples: int, n_features: int, sparsity: float = 0.97, sigma: float = 2.0,
+                seed: int = 0) -> tuple:
+    """
+    Creates a first and second visit table for the same samples, files are reused if they exist
+    :return: paths of the visit1 and visit2 .pcl files
+    """
+    prefix = f"otus-synthetic_s{n_samples}_f{n_features}_p{sparsity}_l{sigma}_r{seed}"
+    paths = tuple(os.path.join(output_dir, f"{prefix}-visit{visit}.pcl") for visit in (1, 2))
+    if all(os.path.exists(path) for path in paths):
+        return paths
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    rng = np.random.RandomState(seed)
+    features = lineage_names(n_features)
+    samples = [f"S{sample:06d}" for sample in range(n_samples)]
+    visit1 = synthetic_abundances(n_samples, n_features, sparsity=sparsity, sigma=sigma, rng=rng)
+    write_pcl(paths[0], visit1, features, samples)
+    write_pcl(paths[1], next_visit(visit1, rng=rng), features, samples)
+    return paths
@@ -4,8 +4,10 @@ from src.download_files import *
 from src.mothur_process import *
 from src.util import *
 from src.idability import *
+from src.sweep import *
+from src.bootstrap import *
 from src.postprocessing import *
-from typing import Optional
+from typing import List, Optional
 
 ROOT = "."
 app = typer.Typer()
@@ -13,27 +15,65 @@ app = typer.Typer()
 
 @app.command()
 def create(input_dir: str = typer.Argument(..., help='Folder with files containing download and metadata information'),
-           num_visits: int = 2) -> None:
+           num_visits: int = 2,
+           jobs: int = typer.Option(4, help="Number of threads writing the files")) -> None:
     """
     Creates two folders with files per body site and visit, one downloading and metadata.
     :param num_visits: Number of visits to be included (<= visit number)
     :param input_dir: Folder with files containing download and metadata information
+    :param jobs: Number of threads writing the files
     :return:
     """
-    merge_files(input_dir)
-    create_folders()
+    total = merge_files(input_dir)
     print(f"\nCreating files for {num_visits} visits")
-    export_all(num_visits)
+    export_all(num_visits, total, jobs=jobs)
     print("Done creating folders and files for download.")
 
 
 @app.command()
-def download(download_dir: str = typer.Argument(..., help='Folder with files containing download information')) -> None:
+def download(download_dir: str = typer.Argument(..., help='Folder with files containing download information'),
+             jobs: int = typer.Option(8, help="Number of files downloaded at the same time"),
+             per_host: int = typer.Option(4, help="Maximum number of files downloaded at the same time from one host"),
+             retries: int = typer.Option(2, help="Number of retries of a failed download"),
+             verify_jobs: int = typer.Option(4, help="Number of threads verifying md5 checksums"),
+             extract: bool = typer.Option(False, help="Extract files while downloading, without saving the "
+                                                      "archives (no decompress and clean needed)"),
+             keep_gz: bool = typer.Option(False, help="With --extract, keep .fastq.gz files compressed for "
+                                                      "extract-taxonomy --gz"),
+             engine: str = typer.Option("http", help="Download with the built-in HTTP client (http) or "
+                                                     "portal_client (portal), e.g. for fasp/s3/gs urls")) -> None:
     """
     Downloads files from the portal.
     :param download_dir: Folder with files containing download information, created after running creat command
+    :param jobs: Number of files downloaded at the same time
+    :param per_host: Maximum number of files downloaded at the same time from one host
+    :param retries: Number of retries of a failed download
+    :param verify_jobs: Number of threads verifying md5 checksums
+    :param extract: Extract files while downloading
+    :param keep_gz: Keep .gz files compressed when extracting
+    :param engine: http or portal
     :return:
     """
+    if engine == "http":
+        # all files of all body sites and visits are downloaded from one queue
+        # finished and partial files of earlier runs are recorded next to the data folder
+        ledger = DownloadLedger(f"{ROOT}/{LEDGER_NAME}")
+        try:
+            results = download_all(collect_tasks(download_dir, f"{ROOT}/data"), jobs=jobs, per_host=per_host,
+                                   retries=retries, ledger=ledger, verify_jobs=verify_jobs, extract=extract,
+                                   keep_gz=keep_gz)
+        finally:
+            ledger.close()
+        skipped = [result for result in results if result["status"] == "skipped"]
+        failed = [result for result in results if result["status"] == "failed"]
+        if skipped:
+            print(f"\n{len(skipped)} files were already downloaded in an earlier run.")
+        if failed:
+            print(f"\n{len(failed)} files could not be downloaded, run the command again to retry them.")
+        print("\nDone downloading files.")
+        return
+    assert engine == "portal", f"Unknown download engine {engine}"
+
     first_folder = True  # for formatting console output
 
     # get all possible folders with files
@@ -57,31 +97,34 @@ def download(download_dir: str = typer.Argument(..., help='Folder with files con
 
 
 @app.command()
-def decompress(data_dir: str = typer.Argument(..., help='Folder with downloaded files')) -> None:
+def decompress(data_dir: str = typer.Argument(..., help='Folder with downloaded files'),
+               jobs: int = typer.Option(os.cpu_count(), help="Number of processes extracting files"),
+               keep_gz: bool = typer.Option(False, help="Only unpack .tar files and keep .fastq.gz files compressed "
+                                                        "for extract-taxonomy --gz")) -> None:
     """
     Unzips all downloaded files.
     :param data_dir: Folder with downloaded files
+    :param jobs: Number of processes extracting files
+    :param keep_gz: Only unpack .tar files
     :return:
     """
-    for folder in os.listdir(data_dir):
-        print("Extracting files from:", folder)
-        body_study_dir = os.path.join(data_dir, folder)
-        unpack_tar(body_study_dir)
-        unpack_gz(body_study_dir)
+    decompress_all(data_dir, jobs=jobs, keep_gz=keep_gz)
 
     print("\nDone extracting files.")
 
 
 @app.command()
-def clean(data_dir: str = typer.Argument(..., help='Folder with downloaded files')) -> None:
+def clean(data_dir: str = typer.Argument(..., help='Folder with downloaded files'),
+          keep_gz: bool = typer.Option(False, help="Only remove .tar files and keep .fastq.gz files")) -> None:
     """
     Cleans all body site data folders of .tar and .gz files.
+    :param keep_gz: Only remove .tar files
     :return:
     """
     for folder in os.listdir(data_dir):
         print("Cleaning files from:", folder)
         body_study_dir = os.path.join(data_dir, folder)
-        clean_folder(body_study_dir)
+        clean_folder(body_study_dir, keep_gz=keep_gz)
 
     print("\nDone cleaning folders.")
 
@@ -90,7 +133,8 @@ def clean(data_dir: str = typer.Argument(..., help='Folder with downloaded files
 def extract_taxonomy(data_dir: str,
                      output_dir_name: Optional[str] = typer.Argument("mothur_output", help='Folder to store taxonomy files'),
                      rerun: bool = typer.Option(False, help="Reruns the whole process of creating files"),
-                     reclassify: bool = typer.Option(False, help="Reruns classification only")) -> None:
+                     reclassify: bool = typer.Option(False, help="Reruns classification only"),
+                     gz: bool = typer.Option(False, help="Use .fastq.gz files as input (decompress --keep-gz)")) -> None:
     if not os.path.exists(output_dir_name):
         os.mkdir(output_dir_name)
 
@@ -105,7 +149,7 @@ def extract_taxonomy(data_dir: str,
                 continue
 
             output_dir = os.path.join(output_dir_name, body_study, visit)
-            run_mothur(visit_dir, output_dir, reclassify=reclassify, rerun=rerun)
+            run_mothur(visit_dir, output_dir, reclassify=reclassify, rerun=rerun, gz=gz)
 
     print("Done creating mothur files.")
 
@@ -122,7 +166,12 @@ def postprocess(data_dir: Optional[str] = typer.Argument("mothur_output", help='
 
 
 @app.command()
-def idability(data_dir: str, code_visit: str = "visit1") -> None:
+def idability(data_dir: str, code_visit: str = "visit1",
+              jobs: int = typer.Option(1, help="Number of processes used to build codes"),
+              rank: Optional[str] = typer.Option(None, help=f"Sum features up to a taxonomic rank "
+                                                             f"({', '.join(c_ranks)})"),
+              results: Optional[str] = typer.Option(None, help="Write all evaluations to this one .tsv file "
+                                                               "instead of one .eval.txt file per visit")) -> None:
     """
     Runs idability software to extract codes and confusion matrix
     """
@@ -130,30 +179,151 @@ def idability(data_dir: str, code_visit: str = "visit1") -> None:
     if not os.path.exists(code_dir):
         os.makedirs(code_dir)
 
-    code_file = ""
+    code_file, code_name = "", ""
+    sample_codes = None
     for file in os.listdir(data_dir):
         if file.endswith(f"{code_visit}.pcl"):
             print("Creating code for :", file)
-            code_file = os.path.join(code_dir, file[:-4] + ".codes.txt")
-            args_list = [os.path.join(data_dir, file), "-o", code_file]
-            run_idability(args_list)
+            code_name = file[:-4]
+            code_file = os.path.join(code_dir, code_name + ".codes.txt")
+            table = load_table(os.path.join(data_dir, file))
+            sample_codes = encode(table if rank is None else rollup_table(table, rank), jobs=jobs)
+            write_codes(sample_codes, code_file)
             print()  # for improving readablity of output
 
+    if sample_codes is None:
+        print(f"No {code_visit}.pcl file found in {data_dir}")
+        return
+
     eval_dir: str = "idability_output/eval"
 
-    if not os.path.exists(eval_dir):
+    if results is None and not os.path.exists(eval_dir):
         os.makedirs(eval_dir)
+    evaluations = []
 
     for file in os.listdir(data_dir):
-        if not file.endswith("visit1.pcl"):
+        if file.endswith(".pcl") and not file.endswith(f"{code_visit}.pcl"):
             print("Evaluating code for :", file)
             print("Using code file :", code_file)
-            args_list = [os.path.join(data_dir, file),
-                         "-c", code_file,
-                         "-o", os.path.join(eval_dir, file[:-4] + ".eval.txt")]
-            run_idability(args_list)
+            table = load_table(os.path.join(data_dir, file))
+            sample_hits = decode(table if rank is None else rollup_table(table, rank), sample_codes)
+            if results is None:
+                write_hits(sample_hits, sample_codes, os.path.join(eval_dir, file[:-4] + ".eval.txt"))
+            else:
+                evaluations.append((code_name, file[:-4], sample_hits, sample_codes))
             print()
 
+    if results is not None:
+        if os.path.dirname(results) and not os.path.exists(os.path.dirname(results)):
+            os.makedirs(os.path.dirname(results))
+        write_evaluations(evaluations, results)
+
+
+@app.command("convert-codes")
+def convert_codes(input_file: str = typer.Argument(..., help="Codes file (.codes.txt or .codes.npz)"),
+                  output_file: str = typer.Argument(..., help="Converted codes file (.codes.txt or .codes.npz)")) -> None:
+    """
+    Converts a codes file between the text and the binary format, chosen by the file extension (.npz is binary)
+    """
+    write_codes(read_codes(input_file), output_file)
+
+
+@app.command()
+def sweep(data_dir: str = typer.Argument(..., help="Folder with one .pcl file per visit"),
+          pairs: List[str] = typer.Option(["visit1:all"], help="Code visit and evaluated visits as "
+                                                                "<code_visit>:<visit>,<visit> or <code_visit>:all"),
+          abund_detect: str = typer.Option(str(c_epsilon), help="Comma-separated values of -d/--abund_detect"),
+          abund_nondetect: str = typer.Option(str(c_epsilon), help="Comma-separated values of -n/--abund_nondetect"),
+          jaccard: str = typer.Option("none", help="Comma-separated values of -j/--jaccard_similarity_cutoff, "
+                                                   "none disables the knockout"),
+          min_code_size: str = typer.Option("1", help="Comma-separated values of -m/--min_code_size"),
+          ranking: str = typer.Option("rarity", help="Comma-separated values of -r/--ranking"),
+          rank: str = typer.Option("none", help="Comma-separated taxonomic ranks to sum features up to "
+                                                "(values of --rank), none keeps the features"),
+          engine: str = typer.Option("sets", help="Engine used to build codes (sets or bitset)"),
+          jobs: int = typer.Option(1, help="Number of processes used to build codes"),
+          output: str = typer.Option("idability_output/sweep.tsv", help="File to store the results")) -> None:
+    """
+    Runs idability for a grid of parameters, loading every visit table only once.
+    Writes one row with the confusion counts per parameter combination, code visit and evaluated visit.
+    """
+    tables = visit_tables(data_dir)
+    grid = {
+        "abund_detect": [float(value) for value in abund_detect.split(",")],
+        "abund_nondetect": [float(value) for value in abund_nondetect.split(",")],
+        "similarity_cutoff": [None if value == "none" else float(value) for value in jaccard.split(",")],
+        "min_code_size": [int(value) for value in min_code_size.split(",")],
+        "ranking": ranking.split(","),
+        "rank": [None if value == "none" else value for value in rank.split(",")],
+    }
+    results = run_sweep(tables, parse_pairs(pairs, list(tables)), grid, engine=engine, jobs=jobs)
+    write_sweep(results, output)
+
+
+@app.command("idability-matrix")
+def idability_matrix(data_dir: str = typer.Argument(..., help="Folder with one .pcl file per visit of a body site"),
+                     abund_detect: float = typer.Option(c_epsilon, help="-d/--abund_detect of idability"),
+                     abund_nondetect: float = typer.Option(c_epsilon, help="-n/--abund_nondetect of idability"),
+                     jaccard: Optional[float] = typer.Option(None, help="-j/--jaccard_similarity_cutoff of idability"),
+                     min_code_size: int = typer.Option(1, help="-m/--min_code_size of idability"),
+                     ranking: str = typer.Option("rarity", help="-r/--ranking of idability"),
+                     rank: Optional[str] = typer.Option(None, help="--rank of idability"),
+                     engine: str = typer.Option("sets", help="Engine used to build codes (sets or bitset)"),
+                     jobs: int = typer.Option(1, help="Number of processes used to build codes and decode visit pairs"),
+                     output: str = typer.Option("idability_output/matrix", help="Folder to store the results")) -> None:
+    """
+    Creates codes for every visit and evaluates them on every other visit, loading every visit table only once.
+    Writes the confusion counts of all visit pairs and a code visit x evaluated visit matrix of TP, FP and FN rates.
+    """
+    tables = visit_tables(data_dir)
+    parameters = {
+        "abund_detect": abund_detect,
+        "abund_nondetect": abund_nondetect,
+        "similarity_cutoff": jaccard,
+        "min_code_size": min_code_size,
+        "ranking": ranking,
+        "rank": rank,
+    }
+    results = run_matrix(tables, parameters, engine=engine, jobs=jobs)
+    write_matrix(results, output)
+
+
+@app.command()
+def bootstrap(data_dir: str = typer.Argument(..., help="Folder with one .pcl file per visit"),
+              pairs: List[str] = typer.Option(["visit1:all"], help="Code visit and evaluated visits as "
+                                                                    "<code_visit>:<visit>,<visit> or <code_visit>:all"),
+              replicates: int = typer.Option(100, help="Number of random subsets"),
+              subject_fraction: float = typer.Option(0.8, help="Fraction of subjects in each subset"),
+              feature_fraction: float = typer.Option(1.0, help="Fraction of features in each subset"),
+              seed: int = typer.Option(0, help="Seed of the random subsets"),
+              abund_detect: float = typer.Option(c_epsilon, help="-d/--abund_detect of idability"),
+              abund_nondetect: float = typer.Option(c_epsilon, help="-n/--abund_nondetect of idability"),
+              jaccard: Optional[float] = typer.Option(None, help="-j/--jaccard_similarity_cutoff of idability"),
+              min_code_size: int = typer.Option(1, help="-m/--min_code_size of idability"),
+              ranking: str = typer.Option("rarity", help="-r/--ranking of idability"),
+              rank: Optional[str] = typer.Option(None, help="--rank of idability"),
+              engine: str = typer.Option("sets", help="Engine used to build codes (sets or bitset)"),
+              jobs: int = typer.Option(1, help="Number of processes running replicates"),
+              output: str = typer.Option("idability_output/bootstrap", help="Folder to store the results")) -> None:
+    """
+    Runs idability on random subsets of subjects and features, loading every visit table only once.
+    Writes the confusion counts of every replicate and their mean, standard deviation and 95% interval.
+    """
+    tables = visit_tables(data_dir)
+    parameters = {
+        "abund_detect": abund_detect,
+        "abund_nondetect": abund_nondetect,
+        "similarity_cutoff": jaccard,
+        "min_code_size": min_code_size,
+        "ranking": ranking,
+        "rank": rank,
+    }
+    results = run_bootstrap(tables, parse_pairs(pairs, list(tables)), parameters, replicates=replicates,
+                            subject_fraction=subject_fraction, feature_fraction=feature_fraction, seed=seed,
+                            engine=engine, jobs=jobs)
+    write_bootstrap(results, summarize_bootstrap(results), output)
+
+
 if __name__ == "__main__":
     app() # uncomment to use cli interface
 
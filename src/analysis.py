@@ -1,8 +1,9 @@
 import os
-import re
 
 import pandas as pd
 
+from src.create_files import decategorize, find_manifest_files, load_manifest
+
 ROOT = "."
 
 
@@ -14,15 +15,15 @@ def get_metadata(input_dir="./hmp_portal_files") -> pd.DataFrame:
     :return: dataframe of merged metadata
     """
     print("Get visit information...")
-    metadata_regex = re.compile(r'hmp_manifest_metadata_(.*).tsv')  # match hmp_manifest_metadata_*.tsv files
     metadata = pd.DataFrame()
     for body_dir in os.listdir(input_dir):
-        for file in os.listdir(os.path.join(input_dir, body_dir)):
-            if metadata_regex.match(file):
-                meta_file = os.path.join(input_dir, body_dir, file)
-                metadata = pd.concat([pd.read_csv(meta_file, sep='\t'), metadata], axis=0)
+        body_dir = os.path.join(input_dir, body_dir)
+        # uses the typed store of the portal files written by the create command
+        if os.path.isdir(body_dir) and find_manifest_files(body_dir)[0]:
+            metadata = pd.concat([load_manifest(body_dir)["metadata"], metadata], axis=0)
 
-    return metadata
+    # plain dtypes, so that groupby only returns combinations that exist
+    return decategorize(metadata)
 
 
 def get_visits(input_dir="./hmp_portal_files") -> None:
@@ -0,0 +1,228 @@
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import pandas as pd
+
+from src.idability import *
+from src.sweep import confusion_rates
+
+"""
+Bootstrap of idability: encode/decode on many random subsets of subjects and features of tables loaded only once
+"""
+
+# arrays of a Table that are placed in shared memory
+SHARED_ARRAYS = ["indptr", "indices", "data"]
+
+# read-only state of a bootstrap worker process, set once by init_bootstrap_worker
+bootstrap_state = {}
+
+
+def share_tables(tables: dict) -> tuple:
+    """
+    Copies the arrays of every table into shared memory blocks
+    :param tables: table name -> Table
+    :return: (list of SharedMemory blocks, table name -> description to attach them in a worker)
+    """
+    blocks, shared = [], {}
+    for name, table in tables.items():
+        shared[name] = {"features": table.features, "samples": table.samples}
+        for key in SHARED_ARRAYS:
+            array = getattr(table, key)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+            blocks.append(block)
+            shared[name][key] = (block.name, array.shape, array.dtype.str)
+    return blocks, shared
+
+
+def attach_tables(shared: dict) -> tuple:
+    """
+    Tables whose arrays are views of the shared memory blocks created by share_tables
+    :return: (list of SharedMemory blocks, table name -> Table)
+    """
+    blocks, tables = [], {}
+    for name, description in shared.items():
+        arrays = {}
+        for key in SHARED_ARRAYS:
+            block_name, shape, dtype = description[key]
+            block = shared_memory.SharedMemory(name=block_name)
+            arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            blocks.append(block)
+        tables[name] = Table(features=description["features"], samples=description["samples"], **arrays)
+    return blocks, tables
+
+
+def mask_table(table: Table, sample_keep: np.ndarray, feature_keep: np.ndarray) -> Table:
+    """
+    Table with only the kept samples and features, the base table is not changed
+    :param sample_keep: boolean mask over table.samples
+    :param feature_keep: boolean mask over table.features
+    """
+    rows = np.repeat(np.arange(len(table.features)), np.diff(table.indptr))
+    keep = sample_keep[table.indices] & feature_keep[rows]
+    new_rows = np.cumsum(feature_keep) - 1
+    new_cols = np.cumsum(sample_keep) - 1
+    indptr = np.zeros(int(feature_keep.sum()) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(new_rows[rows[keep]], minlength=len(indptr) - 1), out=indptr[1:])
+    return Table(
+        features=[feature for feature, kept in zip(table.features, feature_keep.tolist()) if kept],
+        samples=[sample for sample, kept in zip(table.samples, sample_keep.tolist()) if kept],
+        indptr=indptr,
+        indices=new_cols[table.indices[keep]],
+        data=table.data[keep],
+    )
+
+
+def replicate_masks(replicate: int, subjects: list, features: list, subject_fraction: float,
+                    feature_fraction: float, seed: int) -> tuple:
+    """
+    Random subsets of subjects and features of one replicate, the same for every worker
+    :return: boolean masks over subjects and features
+    """
+    rng = np.random.RandomState([seed, replicate])
+    masks = []
+    for names, fraction in [(subjects, subject_fraction), (features, feature_fraction)]:
+        mask = np.zeros(len(names), dtype=bool)
+        mask[rng.choice(len(names), size=max(1, int(round(fraction * len(names)))), replace=False)] = True
+        masks.append(mask)
+    return tuple(masks)
+
+
+def init_bootstrap_worker(shared: dict, settings: dict) -> None:
+    """
+    Attaches the shared tables once per worker process
+    """
+    blocks, tables = attach_tables(shared)
+    bootstrap_state.update(blocks=blocks, tables=tables, settings=settings)
+    # position of every sample and feature of a table in the subject and feature lists
+    subject_ids = {subject: i for i, subject in enumerate(settings["subjects"])}
+    feature_ids = {feature: i for i, feature in enumerate(settings["features"])}
+    bootstrap_state["ids"] = {name: (np.array([subject_ids[sample] for sample in table.samples], dtype=np.int64),
+                                     np.array([feature_ids[feature] for feature in table.features], dtype=np.int64))
+                              for name, table in tables.items()}
+
+
+def run_replicate(replicate: int) -> list:
+    """
+    Worker entry point: encodes and decodes all pairs on one random subset
+    :return: list of rows with the check_hits counts of every (code table, eval table) pair
+    """
+    settings, tables, ids = bootstrap_state["settings"], bootstrap_state["tables"], bootstrap_state["ids"]
+    subject_mask, feature_mask = replicate_masks(replicate, settings["subjects"], settings["features"],
+                                                 settings["subject_fraction"], settings["feature_fraction"],
+                                                 settings["seed"])
+    parameters = settings["parameters"]
+    masked = {}
+
+    def table(name):
+        if name not in masked:
+            subject_ids, feature_ids = ids[name]
+            masked[name] = mask_table(tables[name], subject_mask[subject_ids], feature_mask[feature_ids])
+        return masked[name]
+
+    rows = []
+    for code_name, eval_names in settings["pairs"]:
+        sample_codes = encode(table(code_name), abund_detect=parameters["abund_detect"],
+                              abund_nondetect=parameters["abund_nondetect"],
+                              similarity_cutoff=parameters["similarity_cutoff"],
+                              min_code_size=parameters["min_code_size"], ranking=parameters["ranking"],
+                              engine=settings["engine"])
+        for eval_name in eval_names:
+            sample_hits = decode(table(eval_name), sample_codes, abund_detect=parameters["abund_detect"],
+                                 abund_nondetect=parameters["abund_nondetect"])
+            confusion = check_hits(sample_hits, sample_codes)
+            # the samples of the code table that are also in the eval table
+            eval_samples = set(table(eval_name).samples)
+            shared = check_hits({sample: hits for sample, hits in sample_hits.items() if sample in eval_samples},
+                                {sample: code for sample, code in sample_codes.items() if sample in eval_samples})
+            row = {"replicate": replicate, "code_table": code_name, "eval_table": eval_name}
+            row.update({key: confusion[key] for key in sorted(confusion)})
+            row.update(confusion_rates(confusion, shared))
+            rows.append(row)
+    return rows
+
+
+def run_bootstrap(table_paths: dict, pairs: list, parameters: dict, replicates: int = 100,
+                  subject_fraction: float = 0.8, feature_fraction: float = 1.0, seed: int = 0,
+                  engine: str = "sets", jobs: int = 1) -> pd.DataFrame:
+    """
+    Runs encode/decode on random subsets of subjects and features of the tables
+    :param table_paths: table name -> .pcl path
+    :param pairs: list of (code table name, list of eval table names)
+    :param parameters: one value for each of SWEEP_PARAMETERS
+    :param replicates: number of random subsets
+    :param subject_fraction: fraction of the subjects (sample names of all tables) in each subset
+    :param feature_fraction: fraction of the features in each subset
+    :return: tidy DataFrame with one row per replicate and pair, with the check_hits counts and rates
+    """
+    names = list(dict.fromkeys([name for code_name, eval_names in pairs for name in [code_name] + eval_names]))
+    tables = {}
+    for name in names:
+        print("Loading table :", table_paths[name])
+        tables[name] = load_table(table_paths[name])
+        if parameters.get("rank") is not None:
+            tables[name] = rollup_table(tables[name], parameters["rank"])
+    settings = {
+        "subjects": list(dict.fromkeys(sample for table in tables.values() for sample in table.samples)),
+        "features": list(dict.fromkeys(feature for table in tables.values() for feature in table.features)),
+        "pairs": pairs,
+        "parameters": parameters,
+        "subject_fraction": subject_fraction,
+        "feature_fraction": feature_fraction,
+        "seed": seed,
+        "engine": engine,
+    }
+    blocks, shared = share_tables(tables)
+    del tables
+    print(f"Running {replicates} replicates with {jobs} processes")
+    try:
+        if jobs > 1:
+            with multiprocessing.Pool(jobs, initializer=init_bootstrap_worker, initargs=(shared, settings)) as pool:
+                results = pool.map(run_replicate, range(replicates))
+        else:
+            init_bootstrap_worker(shared, settings)
+            results = [run_replicate(replicate) for replicate in range(replicates)]
+    finally:
+        for block in bootstrap_state.pop("blocks", []):
+            block.close()
+        bootstrap_state.clear()
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return pd.DataFrame([row for rows in results for row in rows])
+
+
+def summarize_bootstrap(results: pd.DataFrame, confidence: float = 0.95) -> pd.DataFrame:
+    """
+    Mean, standard deviation and percentile interval of every count and rate over the replicates
+    :return: DataFrame with one row per (code table, eval table, statistic)
+    """
+    values = [column for column in results.columns if column not in ("replicate", "code_table", "eval_table")]
+    low, high = (1 - confidence) / 2, 1 - (1 - confidence) / 2
+    rows = []
+    for (code_name, eval_name), group in results.groupby(["code_table", "eval_table"], sort=False):
+        for value in values:
+            column = group[value]
+            rows.append({
+                "code_table": code_name,
+                "eval_table": eval_name,
+                "statistic": value,
+                "mean": column.mean(),
+                "std": column.std(),
+                "ci_low": column.quantile(low),
+                "median": column.median(),
+                "ci_high": column.quantile(high),
+            })
+    return pd.DataFrame(rows)
+
+
+def write_bootstrap(results: pd.DataFrame, summary: pd.DataFrame, output_dir: str) -> None:
+    """
+    Saves the counts of every replicate and the summary as .tsv files
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    results.to_csv(os.path.join(output_dir, "replicates.tsv"), sep="\t", index=False)
+    summary.to_csv(os.path.join(output_dir, "summary.tsv"), sep="\t", index=False)
+    print("wrote bootstrap results to:", output_dir)
@@ -1,125 +1,193 @@
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 
 ROOT = "."
 
 
-def merge_files(input_dir):
+# typed binary copy of the parsed portal files, saved next to them in the input folder
+MANIFEST_STORE = "hmp_manifest.pkl"
+# string columns with at most this fraction of distinct values are stored as categoricals
+CATEGORY_FRACTION = 0.5
+# id columns that are always read as strings
+STRING_COLUMNS = {"sample_id": str, "file_id": str, "md5": str, "urls": str}
+
+
+def find_manifest_files(input_dir: str) -> tuple:
     """
-    This method merges the download .tsv file with the metadata .tsv file by sample id.
-    Saves it into a file called total_info.tsv if not named otherwise
+    Finds the metadata and download .tsv files downloaded from the portal
+    :return: (paths of all hmp_manifest_metadata_*.tsv files, path of the hmp_manifest_*.tsv file or "" if not found)
     """
-
-    print("Merging files...")
     metadata_regex = re.compile(r'hmp_manifest_metadata_(.*).tsv')  # match hmp_manifest_metadata_*.tsv files
     download_regex = re.compile(r'hmp_manifest_(?!metadata)')  # match hmp_manifest_*.tsv files
 
-    meta_file = ""
+    meta_files = []
     download_file = ""
 
     for root, dirs, files in os.walk(input_dir):
         for file in files:
             if metadata_regex.match(file):
-                meta_file = os.path.join(root, file)
+                meta_files.append(os.path.join(root, file))
             if download_regex.match(file):
                 download_file = os.path.join(root, file)
+    return meta_files, download_file
+
 
-    download_info = pd.read_csv(download_file, sep='\t')
-    metadata = pd.read_csv(meta_file, sep='\t').drop_duplicates()
-    total = pd.merge(metadata, download_info, validate="one_to_many", on="sample_id")
-    print("Body sites included in the dataset: %s" % (str(total["sample_body_site"].unique())))
+def manifest_stamp(paths: list) -> list:
+    """
+    Size and modification time identifying the current version of the portal files
+    """
+    return [(path, os.stat(path).st_size, os.stat(path).st_mtime_ns) if path else None for path in paths]
+
+
+def categorize(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts string columns with repeated values (body site, study, shared urls, ...) to categoricals
+    """
+    for column in frame.columns:
+        values = frame[column]
+        if not pd.api.types.is_numeric_dtype(values) and values.nunique() <= CATEGORY_FRACTION * len(values):
+            frame[column] = values.astype("category")
+    return frame
+
+
+def decategorize(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts categorical columns back to the dtype of their values, e.g. for a groupby over existing values only
+    """
+    for column in frame.columns:
+        if isinstance(frame[column].dtype, pd.CategoricalDtype):
+            frame[column] = frame[column].astype(frame[column].cat.categories.dtype)
+    return frame
 
-    # puts subject id as first column
-    subject_ids = total['subject_id']
-    total = total.drop(columns=['subject_id'])
-    total.insert(loc=0, column='subject_id', value=subject_ids)
+
+def read_manifest(meta_files: list, download_file: str) -> dict:
+    """
+    Parses the portal files and merges the download information with the metadata by sample id
+    :param meta_files: metadata files, the download information is merged with the last one
+    :return: dict with the "metadata" of all metadata files and the merged "total" DataFrame (None without download
+        file)
+    """
+    frames = [pd.read_csv(meta_file, sep='\t', dtype=STRING_COLUMNS) for meta_file in meta_files]
+    total = None
+    if download_file:
+        download_info = pd.read_csv(download_file, sep='\t', dtype=STRING_COLUMNS)
+        total = pd.merge(frames[-1].drop_duplicates(), download_info, validate="one_to_many", on="sample_id")
+
+        # puts subject id as first column
+        subject_ids = total['subject_id']
+        total = total.drop(columns=['subject_id'])
+        total.insert(loc=0, column='subject_id', value=subject_ids)
+        total = categorize(total)
+    # later files first, the order get_metadata always concatenated them in
+    metadata = pd.concat(frames[::-1], axis=0) if frames else pd.DataFrame()
+    return {"metadata": categorize(metadata), "total": total}
+
+
+def load_manifest(input_dir: str, cache: bool = True) -> dict:
+    """
+    Loads the portal files of a folder, using the typed store (<input_dir>/hmp_manifest.pkl) when it
+    matches the files' size and mtime, and writing one otherwise
+    :return: dict with the "metadata" and the merged "total" DataFrame (None without download file)
+    """
+    meta_files, download_file = find_manifest_files(input_dir)
+    store_path = os.path.join(input_dir, MANIFEST_STORE)
+    stamp = manifest_stamp(meta_files + [download_file])
+    if cache and os.path.exists(store_path):
+        try:
+            store = pd.read_pickle(store_path)
+            if store["stamp"] == stamp and set(store["manifest"]) == {"metadata", "total"}:
+                return store["manifest"]
+        except Exception as e:
+            # truncated, written by another pandas version or in an older layout: the store is rebuilt
+            print(f"unable to read manifest store ({type(e).__name__}), rebuilding it:", store_path)
+    manifest = read_manifest(meta_files, download_file)
+    if cache:
+        try:
+            pd.to_pickle({"stamp": stamp, "manifest": manifest}, store_path + ".tmp", compression=None)
+            os.replace(store_path + ".tmp", store_path)
+        except OSError:
+            print("unable to write manifest store:", store_path)
+    return manifest
+
+
+def merge_files(input_dir, cache=True):
+    """
+    This method merges the download .tsv file with the metadata .tsv file by sample id.
+    Saves it into a file called total_info.tsv if not named otherwise
+    :return: merged DataFrame, kept in memory for export_all
+    """
+
+    print("Merging files...")
+    total = load_manifest(input_dir, cache=cache)["total"]
+    print("Body sites included in the dataset: %s" % (str(list(total["sample_body_site"].unique()))))
     total.to_csv(f"{ROOT}/total_info.tsv", index=False)
     return total
 
 
-def create_folders():
+def study_folder_name(body_site: str, study_name: str) -> str:
     """
-    Creates folder structure for the final .tsv files
+    Name of the folder of a body site and study, e.g. feces_ibdmbd
     """
-    downloaddir = f"{ROOT}/download"
-    metadatadir = f"{ROOT}/metadata"
-
-    # create folders for download and metadata files
-    if not os.path.isdir(downloaddir):
-        os.makedirs(downloaddir)
-        print("Created folder : ", downloaddir)
+    if study_name == "Inflammatory Bowel Disease Multi-omics Database (IBDMDB)":
+        study_name = "ibdmbd"
+    else:
+        study_name = study_name.replace(" ", "_")
+    return f"{body_site.replace(' ', '_')}_{study_name}"
 
-    if not os.path.isdir(metadatadir):
-        os.makedirs(metadatadir)
-        print("Created folder : ", metadatadir)
 
-    # extract body sites and study names
-    total = pd.read_csv(f"{ROOT}/total_info.tsv")
-    body_sites = total['sample_body_site'].unique()
-    study_names = total['study_full_name'].unique()
+def create_folders(body_site: str, study_name: str) -> tuple:
+    """
+    Creates the download and metadata folders of a body site and study
+    :return: paths of the download and metadata folders
+    """
+    folder_name = study_folder_name(body_site, study_name)
+    filedir = f"{ROOT}/download/{folder_name}"
+    metafiledir = f"{ROOT}/metadata/{folder_name}_metadata"
 
-    # create folder for files
-    for body_site in body_sites:
-        for study_name in study_names:
-            if study_name == "Inflammatory Bowel Disease Multi-omics Database (IBDMDB)":
-                study_name = "ibdmbd"
-            else:
-                study_name = study_name.replace(" ", "_")
-            body_site = body_site.replace(" ", "_")
-            filedir = f"{downloaddir}/{body_site}_{study_name}"
-            metafiledir = f"{metadatadir}/{body_site}_{study_name}_metadata"
+    for folder in (filedir, metafiledir):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+            print("Created folder : ", folder)
+    return filedir, metafiledir
 
-            if not os.path.isdir(filedir):
-                os.makedirs(filedir)
-                print("Created folder : ", filedir)
 
-            if not os.path.isdir(metafiledir):
-                os.makedirs(metafiledir)
-                print("Created folder : ", metafiledir)
+def export_visit(filtered: pd.DataFrame, filedir: str, metafiledir: str, visit: int) -> None:
+    """
+    Saves the download and metadata .tsv files of the samples of one visit
+    """
+    download = filtered[["file_id", "md5", "size", "urls", "sample_id", "subject_id"]]
+    metadata = filtered[["sample_id", "sample_body_site", "study_full_name", "visit_number", "subject_id"]]
+    download.to_csv(f"{filedir}/visit{visit}.tsv", sep='\t', index=False)
+    metadata.to_csv(f"{metafiledir}/visit{visit}_metadata.tsv", sep='\t', index=False)
 
 
-def export_all(num_visit: int):
+def export_all(num_visit: int, total: pd.DataFrame = None, jobs: int = 4):
     """
     Exports all visits separately for each body site. The final .tsv files are saved in folders
-    with names ./download/<body_site>_<study_name> and ./metadata/<body_site>_<body_site>_<study_name>_metadata
+    with names ./download/<body_site>_<study_name> and ./metadata/<body_site>_<study_name>_metadata.
+    Folders and files are only created for combinations of body site, study and visit with samples.
     :param num_visit: number of visits to extract, all visits <= numvisit are exported
+    :param total: merged DataFrame returned by merge_files, read from total_info.tsv if not given
+    :param jobs: number of threads writing the files
     """
 
-    total = pd.read_csv(f"{ROOT}/total_info.tsv")
-    downloaddir = f"{ROOT}/download"
-    metadatadir = f"{ROOT}/metadata"
-
-    # extract body sites and study names
-    body_sites = total['sample_body_site'].unique()
-    study_names = total['study_full_name'].unique()
-    all_visits = total['visit_number'].unique()
-    visits = list(filter(lambda score: score <= num_visit, all_visits))  # filter all visits smaller than numvisit
-
-    for body_site in body_sites:
-        for study_name in study_names:
-            body_site = body_site.replace(" ", "_")
-
-            # save files with correct name formatting
-            if study_name == "Inflammatory Bowel Disease Multi-omics Database (IBDMDB)":
-                study_dir_name = "ibdmbd"
-            else:
-                study_dir_name = study_name.replace(" ", "_")
-
-            filedir = f"{downloaddir}/{body_site}_{study_dir_name}"
-            metafiledir = f"{metadatadir}/{body_site}_{study_dir_name}_metadata"
-
-            # create dataframe for each visit
-            for visit in visits:
-                print(f"Creating files for {body_site} from {study_name} visit {visit}")
-                filtered = total[(total['visit_number'] == visit)
-                                 & (total['sample_body_site'] == body_site.replace("_", " "))
-                                 & (total['study_full_name'] == study_name)]
-                download = filtered[["file_id", "md5", "size", "urls", "sample_id", "subject_id"]]
-                metadata = filtered[["sample_id", "sample_body_site", "study_full_name", "visit_number", "subject_id"]]
-
-                download_file_name = f"{filedir}/visit{visit}.tsv"
-                metadata_file_name = f"{metafiledir}/visit{visit}_metadata.tsv"
-                download.to_csv(download_file_name, sep='\t', index=False)
-                metadata.to_csv(metadata_file_name, sep='\t', index=False)
+    if total is None:
+        total = pd.read_csv(f"{ROOT}/total_info.tsv")
+    total = total[total['visit_number'] <= num_visit]  # filter all visits smaller than numvisit
+    folders = {}
+
+    # one pass over all existing combinations instead of filtering the table for each of them
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        writes = []
+        groups = total.groupby(['sample_body_site', 'study_full_name', 'visit_number'], sort=True,
+                                observed=True)
+        for (body_site, study_name, visit), filtered in groups:
+            if (body_site, study_name) not in folders:
+                folders[body_site, study_name] = create_folders(body_site, study_name)
+            print(f"Creating files for {body_site.replace(' ', '_')} from {study_name} visit {visit}")
+            writes.append(executor.submit(export_visit, filtered, *folders[body_site, study_name], visit))
+        for write in writes:
+            write.result()  # raises errors of the writes
@@ -1,10 +1,38 @@
 import argparse
+import hashlib
+import json
 import os
+import shutil
+import sqlite3
+import tarfile
+import threading
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 
+import pandas as pd
 import portal_client
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.util import extract_stream, move_files
 
 ROOT = "."
 
+# one row of a download manifest and the folder its file is saved to
+DownloadTask = namedtuple("DownloadTask", ["file_id", "urls", "size", "md5", "destination"])
+
+# url schemes handled by the download engine, in order of preference
+HTTP_SCHEMES = ["https", "http"]
+# bytes read from a response and written to a file at a time
+CHUNK_SIZE = 1 << 20
+# bytes read from a file at a time to verify its md5 checksum
+VERIFY_BUFFER_SIZE = 8 << 20
+# sqlite file recording the state of every downloaded file, saved next to the data folder
+LEDGER_NAME = "data.ledger.sqlite"
+
 
 def download_files(download_file: str, data_dir: str = f"{ROOT}/data") -> None:
     """
@@ -129,3 +157,416 @@ def download_files(download_file: str, data_dir: str = f"{ROOT}/data") -> None:
     args.password = None
     portal_client.parse_cli = lambda: args
     portal_client.main()
+
+
+def parse_size(value: str) -> int:
+    """
+    File size of a manifest row, which is written as a float (e.g. 48414720.0) if some rows have no size
+    :return: size in bytes, None if the row has no size
+    """
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+
+def manifest_tasks(download_file: str, data_dir: str) -> list:
+    """
+    Reads the rows of a download .tsv file
+    :param download_file: .tsv file with download information
+    :param data_dir: name of folder to save the files to
+    :return: list of DownloadTask
+    """
+    manifest = pd.read_csv(download_file, sep='\t', dtype=str, keep_default_na=False)
+    return [DownloadTask(file_id=row.file_id, urls=row.urls.split(","), size=parse_size(row.size), md5=row.md5,
+                         destination=data_dir) for row in manifest.itertuples()]
+
+
+def collect_tasks(download_dir: str, data_dir: str = f"{ROOT}/data") -> list:
+    """
+    Gathers the rows of all download .tsv files created by the create command into one list. The files of
+    <download_dir>/<body_site>_<study_name>/visit1.tsv are saved to <data_dir>/<body_site>_<study_name>/visit1
+    :return: list of DownloadTask
+    """
+    tasks = []
+    for folder in sorted(os.listdir(download_dir)):
+        body_study_dir = os.path.join(download_dir, folder)
+        if os.path.isdir(body_study_dir):
+            for file in sorted(os.listdir(body_study_dir)):
+                if file.endswith(".tsv"):
+                    tasks += manifest_tasks(os.path.join(body_study_dir, file),
+                                            os.path.join(data_dir, folder, file[:-4]))
+    return tasks
+
+
+def http_url(urls: list) -> str:
+    """
+    The url of a file that is downloaded over HTTP, None if the file has none
+    """
+    for scheme in HTTP_SCHEMES:
+        for url in urls:
+            if urlparse(url.strip()).scheme == scheme:
+                return url.strip()
+    return None
+
+
+def make_session(per_host: int) -> requests.Session:
+    """
+    HTTP session reusing up to per_host connections to every host
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=per_host)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class HostLimits:
+    """
+    Bounds the number of transfers running at the same time per host
+    """
+
+    def __init__(self, per_host: int):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def __call__(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.semaphores[host]
+
+
+class DownloadLedger:
+    """
+    Records the state of every manifest file in a sqlite table keyed by file_id, md5 and size:
+    partial (<path>.part can be resumed), downloaded (complete, md5 not checked yet), verified, extracted
+    (streamed into its visit folder by fetch_extract, with the keep_gz mode and the extracted files) or failed
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files (file_id TEXT NOT NULL, md5 TEXT NOT NULL, size INTEGER NOT NULL, "
+                "path TEXT, status TEXT NOT NULL, updated REAL NOT NULL, extracted TEXT, "
+                "PRIMARY KEY (file_id, md5, size))")
+            # ledgers of earlier versions have no extracted column
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+            if "extracted" not in columns:
+                self.connection.execute("ALTER TABLE files ADD COLUMN extracted TEXT")
+
+    def status(self, task: DownloadTask) -> str:
+        """
+        State of the file of a manifest row, None if it is not in the ledger
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT status FROM files WHERE file_id = ? AND md5 = ? AND size = ?",
+                                          (task.file_id, task.md5, task.size)).fetchone()
+        return None if row is None else row[0]
+
+    def extraction(self, task: DownloadTask) -> dict:
+        """
+        keep_gz mode and files (relative to the visit folder) of an extracted file, None if it was not extracted
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT status, extracted FROM files WHERE file_id = ? AND md5 = ? AND "
+                                          "size = ?", (task.file_id, task.md5, task.size)).fetchone()
+        if row is None or row[0] != "extracted" or row[1] is None:
+            return None
+        return json.loads(row[1])
+
+    def update(self, task: DownloadTask, path: str, status: str, extraction: dict = None) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO files (file_id, md5, size, path, status, updated, "
+                                    "extracted) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (task.file_id, task.md5, task.size, path, status, time.time(),
+                                     None if extraction is None else json.dumps(extraction)))
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def file_md5(path: str, buffer_size: int = VERIFY_BUFFER_SIZE) -> str:
+    """
+    md5 checksum of a file, read into one reused buffer
+    """
+    md5 = hashlib.md5()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as fh:
+        for size in iter(lambda: fh.readinto(buffer), 0):
+            md5.update(view[:size])
+    return md5.hexdigest()
+
+
+def fetch_file(task: DownloadTask, url: str, path: str, session: requests.Session, timeout: float) -> str:
+    """
+    Streams the file at url to <path>.part, which is renamed to path when it is complete.
+    An existing <path>.part is resumed with an HTTP Range request.
+    :return: md5 checksum computed while writing, None if the transfer was resumed
+    """
+    offset = os.path.getsize(path + ".part") if os.path.exists(path + ".part") else 0
+    if offset >= task.size:
+        offset = 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with session.get(url, stream=True, timeout=timeout, headers=headers) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0  # the server sends the whole file
+        md5 = hashlib.md5() if offset == 0 else None
+        written = offset
+        with open(path + ".part", "ab" if offset else "wb") as fh:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                fh.write(chunk)
+                if md5 is not None:
+                    md5.update(chunk)
+                written += len(chunk)
+    if written > task.size:
+        os.remove(path + ".part")
+    if written != task.size:
+        raise ValueError(f"expected {task.size} bytes, got {written}")
+    os.replace(path + ".part", path)
+    return None if md5 is None else md5.hexdigest()
+
+
+class HashingReader:
+    """
+    Readable stream over the chunks of a download, computing their md5 checksum and size
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b""
+        self.position = 0
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        while size is None or size != 0:
+            if self.position == len(self.chunk):
+                self.chunk, self.position = next(self.chunks, b""), 0
+                if not self.chunk:
+                    break
+                self.md5.update(self.chunk)
+                self.size += len(self.chunk)
+            end = len(self.chunk) if size is None or size < 0 else self.position + size
+            part = self.chunk[self.position:end]
+            self.position += len(part)
+            parts.append(part)
+            if size is not None and size > 0:
+                size -= len(part)
+        return b"".join(parts)
+
+    def drain(self) -> None:
+        """ reads the rest of the stream, e.g. the padding after the end of a .tar archive """
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def fetch_extract(task: DownloadTask, url: str, destination: str, session: requests.Session,
+                  timeout: float, keep_gz: bool = False) -> str:
+    """
+    Streams the file at url through the tar/gzip decoders into destination, so the archive is never saved.
+    The files are extracted into a staging folder and only moved to destination if the size and md5
+    checksum of the download are correct.
+    :param keep_gz: save .gz files compressed, only .tar archives are unpacked
+    :return: md5 checksum of the download and the extracted files (relative to destination)
+    """
+    name = os.path.basename(urlparse(url).path)
+    staging = os.path.join(destination, f".{name}.part")
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    try:
+        with session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            reader = HashingReader(response.iter_content(CHUNK_SIZE))
+            files = [os.path.relpath(file, staging) for file in extract_stream(reader, name, staging, not keep_gz)]
+            reader.drain()
+        if reader.size != task.size:
+            raise ValueError(f"expected {task.size} bytes, got {reader.size}")
+        md5 = reader.md5.hexdigest()
+        if not task.md5 or md5 == task.md5:
+            move_files(staging, destination)
+        return md5, files
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def check_md5(task: DownloadTask, path: str, md5: str, ledger: DownloadLedger = None) -> dict:
+    """
+    Compares the md5 checksum of a downloaded file with the manifest, the file is removed if they differ
+    :return: dict with file_id, path, bytes, status ("ok" or "failed") and error
+    """
+    if task.md5 and md5 != task.md5:
+        os.remove(path)
+        if ledger is not None:
+            ledger.update(task, path, "failed")
+        return {"file_id": task.file_id, "path": path, "bytes": 0, "status": "failed",
+                "error": f"md5 mismatch, expected {task.md5}, got {md5}"}
+    if ledger is not None:
+        ledger.update(task, path, "verified")
+    return {"file_id": task.file_id, "path": path, "bytes": 0, "status": "ok", "error": None}
+
+
+def verify_task(task: DownloadTask, result: dict, ledger: DownloadLedger = None) -> dict:
+    """
+    Verifies the md5 checksum of a file that was resumed or found complete on disk
+    :return: result of check_md5 with the bytes transferred by the download
+    """
+    checked = check_md5(task, result["path"], file_md5(result["path"]), ledger)
+    checked["bytes"] = result["bytes"]
+    return checked
+
+
+def extract_task(task: DownloadTask, url: str, session: requests.Session, host_limits: HostLimits,
+                 ledger: DownloadLedger = None, retries: int = 2, timeout: float = 60, keep_gz: bool = False) -> dict:
+    """
+    Downloads and extracts the file of one manifest row with fetch_extract, failed transfers are restarted.
+    Files that were extracted before in the same way and whose extracted files still exist are skipped.
+    :return: dict with file_id, path (the visit folder), bytes, status ("ok", "skipped" or "failed") and error
+    """
+    record = None if ledger is None else ledger.extraction(task)
+    if record is not None and record["keep_gz"] == keep_gz \
+            and all(os.path.exists(os.path.join(task.destination, file)) for file in record["files"]):
+        return {"file_id": task.file_id, "path": task.destination, "bytes": 0, "status": "skipped", "error": None}
+    error = None
+    for attempt in range(retries + 1):
+        try:
+            with host_limits(url):
+                md5, files = fetch_extract(task, url, task.destination, session, timeout, keep_gz)
+            break
+        except (requests.RequestException, OSError, ValueError, EOFError, tarfile.TarError, zlib.error) as e:
+            error = f"{type(e).__name__}: {e}"
+    else:
+        return {"file_id": task.file_id, "path": task.destination, "bytes": 0, "status": "failed", "error": error}
+    if task.md5 and md5 != task.md5:
+        if ledger is not None:
+            ledger.update(task, task.destination, "failed")
+        return {"file_id": task.file_id, "path": task.destination, "bytes": 0, "status": "failed",
+                "error": f"md5 mismatch, expected {task.md5}, got {md5}"}
+    if record is not None:
+        # files of an extraction in the other keep_gz mode, e.g. .fastq.gz files replaced by .fastq files
+        for file in set(record["files"]) - set(files):
+            if os.path.exists(os.path.join(task.destination, file)):
+                os.remove(os.path.join(task.destination, file))
+    if ledger is not None:
+        ledger.update(task, task.destination, "extracted", {"keep_gz": keep_gz, "files": files})
+    return {"file_id": task.file_id, "path": task.destination, "bytes": task.size, "status": "ok", "error": None}
+
+
+def download_task(task: DownloadTask, session: requests.Session, host_limits: HostLimits,
+                  ledger: DownloadLedger = None, retries: int = 2, timeout: float = 60, extract: bool = False,
+                  keep_gz: bool = False) -> dict:
+    """
+    Downloads the file of one manifest row, retrying and resuming failed transfers
+    :param extract: extract the file into its visit folder while downloading instead of saving it, see extract_task
+    :param keep_gz: when extracting, save .gz files compressed
+    :return: dict with file_id, path, bytes, status and error. The status is "skipped" for files verified
+        in an earlier run, "downloaded" for complete files whose md5 checksum still has to be verified
+        with verify_task, and "ok" or "failed" otherwise
+    """
+    url = http_url(task.urls)
+    if url is None:
+        return {"file_id": task.file_id, "path": None, "bytes": 0, "status": "failed",
+                "error": f"no {'/'.join(HTTP_SCHEMES)} url in {','.join(task.urls)}"}
+    if task.size is None:
+        return {"file_id": task.file_id, "path": None, "bytes": 0, "status": "failed",
+                "error": "no file size in the manifest"}
+    if extract:
+        return extract_task(task, url, session, host_limits, ledger, retries, timeout, keep_gz)
+    path = os.path.join(task.destination, os.path.basename(urlparse(url).path))
+    status = None if ledger is None else ledger.status(task)
+    if os.path.exists(path) and os.path.getsize(path) == task.size:
+        return {"file_id": task.file_id, "path": path, "bytes": 0, "error": None,
+                "status": "skipped" if status == "verified" else "downloaded"}
+    if status != "partial" and os.path.exists(path + ".part"):
+        os.remove(path + ".part")  # not known to belong to this version of the file
+    resumed = os.path.getsize(path + ".part") if os.path.exists(path + ".part") else 0
+
+    error = None
+    for attempt in range(retries + 1):
+        try:
+            with host_limits(url):
+                md5 = fetch_file(task, url, path, session, timeout)
+            if md5 is None:
+                if ledger is not None:
+                    ledger.update(task, path, "downloaded")
+                return {"file_id": task.file_id, "path": path, "bytes": task.size - resumed, "status": "downloaded",
+                        "error": None}
+            result = check_md5(task, path, md5, ledger)
+            result["bytes"] = task.size
+            return result
+        except (requests.RequestException, OSError, ValueError) as e:
+            error = f"{type(e).__name__}: {e}"
+            if ledger is not None and os.path.exists(path + ".part"):
+                ledger.update(task, path, "partial")
+    return {"file_id": task.file_id, "path": path, "bytes": 0, "status": "failed", "error": error}
+
+
+def download_all(tasks: list, jobs: int = 8, per_host: int = 4, retries: int = 2, timeout: float = 60,
+                 session: requests.Session = None, ledger: DownloadLedger = None, verify_jobs: int = 4,
+                 extract: bool = False, keep_gz: bool = False) -> list:
+    """
+    Downloads the files of all manifest rows from one work queue with up to jobs transfers at the same time.
+    Files that were resumed or found on disk are verified on a separate pool while the transfers go on.
+    :param tasks: list of DownloadTask, e.g. from collect_tasks
+    :param jobs: number of concurrent transfers
+    :param per_host: maximum number of concurrent transfers per host
+    :param retries: number of retries of a failed transfer
+    :param timeout: seconds to wait for a connection or data before a transfer fails
+    :param session: HTTP session to use, a pooled session is created if not given
+    :param ledger: DownloadLedger to skip verified files and resume partial ones of earlier runs
+    :param verify_jobs: number of threads verifying md5 checksums
+    :param extract: extract the files into their visit folders while downloading, the archives are not saved
+    :param keep_gz: when extracting, save .gz files compressed and only unpack .tar archives
+    :return: list of results in the order of tasks, with status "ok", "skipped" or "failed"
+    """
+    for destination in sorted(set(task.destination for task in tasks)):
+        if not os.path.isdir(destination):
+            os.makedirs(destination)
+            print("Created folder:", destination)
+
+    session = make_session(per_host) if session is None else session
+    host_limits = HostLimits(per_host)
+    total_bytes = sum(task.size for task in tasks if task.size is not None)
+    print(f"Downloading {len(tasks)} files ({total_bytes / 2 ** 20:.1f} MB) with {jobs} transfers, "
+          f"{per_host} per host")
+    start = time.perf_counter()
+    results = [None] * len(tasks)
+
+    def report(i, result):
+        results[i] = result
+        done = sum(result is not None for result in results)
+        if result["status"] == "ok":
+            print(f"[{done}/{len(tasks)}] Downloaded file:", result["path"])
+        elif result["status"] == "skipped":
+            print(f"[{done}/{len(tasks)}] Already downloaded:", result["path"])
+        else:
+            print(f"[{done}/{len(tasks)}] Failed to download {result['file_id']}:", result["error"])
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as transfers, \
+            ThreadPoolExecutor(max_workers=max(1, verify_jobs)) as verifiers:
+        futures = {transfers.submit(download_task, task, session, host_limits, ledger, retries, timeout, extract,
+                                    keep_gz): i
+                   for i, task in enumerate(tasks)}
+        checks = {}
+        for future in as_completed(futures):
+            i = futures[future]
+            if future.result()["status"] == "downloaded":
+                checks[verifiers.submit(verify_task, tasks[i], future.result(), ledger)] = i
+            else:
+                report(i, future.result())
+        for future in as_completed(checks):
+            report(checks[future], future.result())
+
+    seconds = time.perf_counter() - start
+    downloaded = sum(result["bytes"] for result in results)
+    print(f"Downloaded {downloaded / 2 ** 20:.1f} MB in {seconds:.1f} s "
+          f"({downloaded / 2 ** 20 / max(seconds, 1e-9):.1f} MB/s)")
+    return results
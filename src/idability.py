@@ -35,8 +35,17 @@ from __future__ import print_function  # PYTHON 2.7+ REQUIRED
 
 import argparse
 import csv
+import functools
+import json
+import multiprocessing
 import os
 import sys
+import time
+import tracemalloc
+from collections import namedtuple
+from typing import Dict, List, Optional, Union
+
+import numpy as np
 
 # ---------------------------------------------------------------
 # description
@@ -88,13 +97,26 @@ ARGUMENTS:
 c_na = "#N/A"
 c_epsilon = 1e-20  # original value, abundances smaller than this are ignored
 c_codes_extension = "codes.txt"
+c_binary_codes_extension = "codes.npz"
+c_table_cache_extension = "npz"
 c_hits_extension = "hits.txt"
+c_thresholds_extension = "thresholds.txt"
 c_relab_detect = 0.001
 c_rpkm_detect = 5.0
 c_nondetect_multiplier = 0.01
 c_relax_multiplier = 0.1
 c_min_code_size = 7
 c_max_jaccard = 0.8
+c_ranks = ["kingdom", "phylum", "class", "order", "family", "genus"]
+c_lineage_root = "Root"
+c_confusion_classes = ["1|TP", "3|FN+FP", "2|TP+FP", "4|FN", "5|NA", "6|TN"]
+c_engines = ["sets", "bitset"]
+c_jaccard_indexes = ["exact", "minhash"]
+c_minhash_permutations = 128
+c_minhash_seed = 1729
+c_similarity_block = 1024
+c_minhash_chunk = 1 << 16
+c_popcount = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
 
 
 # ---------------------------------------------------------------
@@ -121,6 +143,24 @@ def get_parser():
         help="""
         Codes file produced in an earlier run.
         Specifying this option will compare codes to input table.
+        Codes files ending in .npz are read as binary codes (see --output).
+        """,
+    )
+    parser.add_argument(
+        "-u", '--update_codes',
+        type=str,
+        help="""
+        Codes file produced in an earlier run on --old_table.
+        Specifying this option will treat the input table as new samples added to --old_table
+        and write codes for the merged population, encoding only the codes the new samples change.
+        The other settings must be the ones used for the earlier run.
+        """,
+    )
+    parser.add_argument(
+        '--old_table',
+        type=str,
+        help="""
+        Table file the --update_codes codes were built from.
         """,
     )
     parser.add_argument(
@@ -178,6 +218,59 @@ def get_parser():
         help="""
         Name for the output file (codes or confusion matrix, depending on mode).
         If not supplied, a default will be constructed from the input file names.
+        Codes are written in a compact binary format if the name ends in .npz (e.g. visit1.codes.npz).
+        """,
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="""
+        Number of worker processes used to build codes.
+        Samples are encoded independently and merged back in sample order.
+        """,
+    )
+    parser.add_argument(
+        "-t", "--detect_thresholds",
+        type=float,
+        nargs="+",
+        help="""
+        Only applied to decode mode. Instead of hits for a single --abund_detect value,
+        report the confusion counts for each of these abund_detect thresholds,
+        all computed in one pass over the table.
+        """,
+    )
+    parser.add_argument(
+        "--no_table_cache",
+        action="store_true",
+        help="""
+        Always parse the table file instead of reading (and writing)
+        its binary sidecar cache (<table>.npz).
+        """,
+    )
+    parser.add_argument(
+        "--rank",
+        type=str,
+        choices=c_ranks,
+        help="""
+        Sum the features of the table(s) up to this taxonomic rank before encoding/decoding.
+        Feature names must be lineages like Root;Bacteria;Firmicutes;...;Genus;
+        """,
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="""
+        Record wall time, cpu time and peak traced memory of each phase
+        (load, flip, reduce, rank, coerce, encode/decode, write) and counts
+        such as samples, features and average code length, and print them as json.
+        """,
+    )
+    parser.add_argument(
+        "--metrics_out", "--metrics-out",
+        type=str,
+        help="""
+        Same as --profile, but write the json to this file.
         """,
     )
     parser.add_argument(
@@ -191,10 +284,119 @@ def get_parser():
         If working with reads per kilobase per million reads (RPKM) data, select the "rpkm" mode.
         """,
     )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=c_engines,
+        default="sets",
+        help="""
+        Data structure used when building codes. The default, sets, intersects
+        python sets of sample names. The alternative, bitset, maps samples to
+        integer indices and intersects packed bit arrays. Both produce identical codes.
+        """,
+    )
+    parser.add_argument(
+        "--jaccard_index",
+        type=str,
+        choices=c_jaccard_indexes,
+        default="exact",
+        help="""
+        How similar features are found for the Jaccard knockout (see -j).
+        The default, exact, precomputes all feature pairs above the cutoff once per table.
+        The alternative, minhash, only checks pairs proposed by MinHash/LSH, which is faster
+        for very wide tables but may miss some similar features.
+        """,
+    )
 
     return parser
 
 
+# ---------------------------------------------------------------
+# run metrics
+# ---------------------------------------------------------------
+
+# per-phase wall time, cpu time and peak traced memory, only collected between start_metrics and stop_metrics
+metrics = {"enabled": False, "active": None, "phases": {}, "counts": {}}
+
+
+def cpu_seconds():
+    """ user + system time of this process and of its finished worker processes """
+    return sum(os.times()[:4])
+
+
+def start_metrics():
+    """ start collecting metrics (and tracing memory allocations) for the phases of a run """
+    metrics.update(enabled=True, active=None, phases={}, counts={})
+    metrics["tracing"] = not tracemalloc.is_tracing()
+    if metrics["tracing"]:
+        tracemalloc.start()
+    metrics["start"] = (time.perf_counter(), cpu_seconds())
+
+
+def stop_metrics():
+    """ stop collecting metrics, returns them as a json-ready dict """
+    wall, cpu = metrics["start"]
+    report = {
+        "phases": metrics["phases"],
+        "counts": metrics["counts"],
+        "total": {
+            "wall_seconds": time.perf_counter() - wall,
+            "cpu_seconds": cpu_seconds() - cpu,
+            # the peak is reset at the start of each phase
+            "peak_traced_bytes": max([tracemalloc.get_traced_memory()[1]] +
+                                     [stats["peak_traced_bytes"] for stats in metrics["phases"].values()]),
+        },
+    }
+    if metrics["tracing"]:
+        tracemalloc.stop()
+    metrics.update(enabled=False, active=None, phases={}, counts={})
+    return report
+
+
+def record_counts(**counts):
+    """ add counts (samples, features, ...) to the metrics of the current run """
+    if metrics["enabled"]:
+        metrics["counts"].update(counts)
+
+
+def profiled(phase):
+    """
+    decorator adding a function's wall time, cpu time and peak traced memory
+    to a phase of the run metrics; calls made inside another phase count for that phase
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics["enabled"] or metrics["active"] is not None:
+                return function(*args, **kwargs)
+            metrics["active"] = phase
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            wall, cpu = time.perf_counter(), cpu_seconds()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats = metrics["phases"].setdefault(
+                    phase, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_traced_bytes": 0})
+                stats["calls"] += 1
+                stats["wall_seconds"] += time.perf_counter() - wall
+                stats["cpu_seconds"] += cpu_seconds() - cpu
+                stats["peak_traced_bytes"] = max(stats["peak_traced_bytes"], tracemalloc.get_traced_memory()[1])
+                metrics["active"] = None
+        return wrapper
+    return decorator
+
+
+def write_metrics(report, path):
+    """ write run metrics to a json file ("-" for stdout) """
+    if path == "-":
+        print(json.dumps(report, indent=2))
+        return
+    with try_open(path, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print("wrote metrics to:", path)
+
+
 # ---------------------------------------------------------------
 # utilities and file i/o
 # ---------------------------------------------------------------
@@ -214,28 +416,186 @@ def map_path_name(path):
     return os.path.split(path)[1].split(".")[0]
 
 
-def load_sfv(path, cutoff):
+# sparse PCL table: rows are features, values stored as CSR arrays over sample columns
+Table = namedtuple("Table", ["features", "samples", "indptr", "indices", "data"])
+
+
+def file_stamp(path):
+    """ size and modification time identifying the current version of a file """
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def parse_table(path):
+    """ vectorized parse of a table file into a Table holding its non-zero values """
+    with try_open(path) as fh:
+        text = fh.read()
+    if '"' in text:
+        # quoted fields need the csv module
+        rows = [row[:1] + ["\t".join(row[1:])] if len(row) > 1 else row
+                for row in csv.reader(text.splitlines(), dialect="excel-tab") if row]
+    else:
+        rows = [line.split("\t", 1) for line in text.splitlines() if line]
+    headers = rows[0][1].split("\t") if rows and len(rows[0]) > 1 else []
+    features = [row[0] for row in rows[1:]]
+    values = np.zeros((len(features), len(headers)))
+    if len(features) > 0 and len(headers) > 0:
+        values = np.loadtxt([row[1] if len(row) > 1 else "" for row in rows[1:]],
+                            delimiter="\t", dtype=np.float64, comments=None, ndmin=2)
+    assert values.shape == (len(features), len(headers)), \
+        "row length mismatch"
+    rows, cols = np.nonzero(values)
+    indptr = np.zeros(len(features) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(features)), out=indptr[1:])
+    return Table(
+        features=features,
+        samples=headers,
+        indptr=indptr,
+        indices=cols.astype(np.int64),
+        data=values[rows, cols],
+    )
+
+
+def read_table_cache(cache_path, stamp):
+    """
+    Table of a binary sidecar, None if it does not match stamp or can not be read
+    (truncated, written by another numpy version or missing arrays)
+    """
+    try:
+        with np.load(cache_path) as npz:
+            if not np.array_equal(npz["stamp"], stamp):
+                return None
+            return Table(
+                features=npz["features"].tolist(),
+                samples=npz["samples"].tolist(),
+                indptr=npz["indptr"],
+                indices=npz["indices"],
+                data=npz["data"],
+            )
+    except Exception:
+        print("unable to read table cache, parsing the table:", cache_path)
+        return None
+
+
+@profiled("load")
+def load_table(path, cache=True):
+    """
+    load a table file as a Table, using a binary sidecar (<path>.npz) when it
+    matches the file's size and mtime, and writing one otherwise
+    """
+    cache_path = "%s.%s" % (path, c_table_cache_extension)
+    stamp = file_stamp(path)
+    if cache and os.path.exists(cache_path):
+        table = read_table_cache(cache_path, stamp)
+        if table is not None:
+            return table
+    table = parse_table(path)
+    if cache:
+        try:
+            with open(cache_path + ".tmp", "wb") as fh:
+                np.savez(
+                    fh,
+                    stamp=stamp,
+                    features=np.array(table.features, dtype=str),
+                    samples=np.array(table.samples, dtype=str),
+                    indptr=table.indptr,
+                    indices=table.indices,
+                    data=table.data,
+                )
+            os.replace(cache_path + ".tmp", cache_path)
+        except OSError:
+            print("unable to write table cache:", cache_path)
+    return table
+
+
+@profiled("load")
+def table_to_sfv(table, cutoff):
+    """ nested dict (sfv: sample->feature->value) of the table's values >= cutoff """
+    sfv = {header: {} for header in table.samples}
+    rows = np.repeat(np.arange(len(table.features)), np.diff(table.indptr))
+    cols, values = table.indices, table.data
+    if cutoff <= 0:
+        # zeros are not stored but pass the cutoff
+        dense = np.zeros((len(table.features), len(table.samples)))
+        dense[rows, cols] = values
+        rows, cols = np.nonzero(dense >= cutoff)
+        values = dense[rows, cols]
+    else:
+        keep = values >= cutoff
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+    features, headers = table.features, table.samples
+    for row, col, value in zip(rows.tolist(), cols.tolist(), values.tolist()):
+        sfv[headers[col]][features[row]] = value
+    return sfv
+
+
+def load_sfv(path, cutoff, cache=True):
     """ 
     loads a table file to a nested dict (sfv: sample->feature->value)
     values below cutoff are ignored to save space 
     """
-    sfv = {}
-    with try_open(path) as fh:
-        headers = None
-        for row in csv.reader(fh, dialect="excel-tab"):
-            if headers is None:
-                headers = row[1:]
-                sfv = {header: {} for header in headers}
-            else:
-                feature, values = row[0], [float(k) for k in row[1:]]
-                assert len(values) == len(headers), \
-                    "row length mismatch"
-                for header, value in zip(headers, values):
-                    if value >= cutoff:
-                        sfv[header][feature] = value
-    return sfv
+    return table_to_sfv(load_table(path, cache=cache), cutoff)
+
+
+# ---------------------------------------------------------------
+# taxonomic roll-up
+# ---------------------------------------------------------------
 
+# prefix tree of feature lineages, flattened per depth: names[depth] are the lineage prefixes
+# (nodes) at that depth and nodes[depth][row] is the node of the table's feature row
+Lineages = namedtuple("Lineages", ["names", "nodes"])
 
+
+def lineage_tree(features):
+    """
+    prefix tree of lineages like Root;Bacteria;Firmicutes;...;Genus; (Root is optional)
+    one level per rank in c_ranks, features with shorter lineages stay their own node
+    """
+    names = [[] for _ in c_ranks]
+    nodes = [np.zeros(len(features), dtype=np.int64) for _ in c_ranks]
+    node_ids = [{} for _ in c_ranks]
+    for row, feature in enumerate(features):
+        taxa = [taxon for taxon in feature.split(";") if taxon != ""]
+        root = taxa[:1] if taxa[:1] == [c_lineage_root] else []
+        taxa = taxa[len(root):]
+        for depth in range(len(c_ranks)):
+            prefix = feature if len(taxa) <= depth else ";".join(root + taxa[:depth + 1]) + ";"
+            if prefix not in node_ids[depth]:
+                node_ids[depth][prefix] = len(names[depth])
+                names[depth].append(prefix)
+            nodes[depth][row] = node_ids[depth][prefix]
+    return Lineages(names=names, nodes=nodes)
+
+
+@profiled("rollup")
+def rollup_table(table, rank, lineages=None):
+    """
+    aggregate a table's features to a taxonomic rank (one of c_ranks) by summing
+    the values of features below the same node: the product of a 0/1
+    node x feature assignment matrix with the sparse table
+    """
+    assert rank in c_ranks, \
+        "unknown rank: %s, choose one of %s" % (rank, ", ".join(c_ranks))
+    lineages = lineage_tree(table.features) if lineages is None else lineages
+    depth = c_ranks.index(rank)
+    names, nodes = lineages.names[depth], lineages.nodes[depth]
+    rows = nodes[np.repeat(np.arange(len(table.features)), np.diff(table.indptr))]
+    # sum values sharing a (node, sample) cell
+    keys, inverse = np.unique(rows * len(table.samples) + table.indices, return_inverse=True)
+    data = np.bincount(inverse.ravel(), weights=table.data, minlength=len(keys))
+    rows, cols = keys // max(len(table.samples), 1), keys % max(len(table.samples), 1)
+    indptr = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(names)), out=indptr[1:])
+    return Table(
+        features=list(names),
+        samples=table.samples,
+        indptr=indptr,
+        indices=cols,
+        data=data,
+    )
+
+
+@profiled("reduce")
 def reduce_sfv(sfv, cutoff, greater=True):
     """
     rebuild sfv with only entries > cutoff
@@ -249,6 +609,7 @@ def reduce_sfv(sfv, cutoff, greater=True):
     return temp
 
 
+@profiled("flip")
 def flip_sfv(sfv):
     """ make a fsv object, i.e. feature->sample->value map """
     fsv = {}
@@ -258,6 +619,7 @@ def flip_sfv(sfv):
     return fsv
 
 
+@profiled("coerce")
 def coerce_to_sets(nested_dict):
     """ reduces inner dict to key set when we're done with values """
     return {outer_key: set(inner_dict) \
@@ -270,32 +632,91 @@ def check_hits(sample_hits, sample_codes):
     sample_hits: dict of sample -> with all samples that match code
     sample_codes: dict of sample -> with corresponding code
     """
-    counts = {k: 0 for k in "1|TP 3|FN+FP 2|TP+FP 4|FN 5|NA 6|TN".split()}
-    codes_samples = sample_codes.keys()  # IDs of samples in code file
-    for sample, hits in sample_hits.items():
-        # if there is no match we additionally check for TN
-        if hits is None:
-            if sample in codes_samples:
-                counts["5|NA"] += 1
-            else:
-                counts["6|TN"] += 1
-        else:
-            tp_hit = True if sample in hits else False
-            fp_hit = True if len([sample2 for sample2 in hits if sample2 != sample]) > 0 else False
-            if tp_hit:
-                key = "2|TP+FP" if fp_hit else "1|TP"
-            else:
-                key = "3|FN+FP" if fp_hit else "4|FN"
+    return hit_confusion(hit_matrix(sample_hits), sample_codes)
+
+
+# codes of all samples as integers: each feature name is stored once in features and the code of
+# samples[i] is features[indices[offsets[i]:offsets[i + 1]]]; missing[i] marks samples without a code
+IndexedCodes = namedtuple("IndexedCodes", ["features", "samples", "offsets", "indices", "missing"])
+
+
+def is_binary_codes(path):
+    """ codes files are binary (IndexedCodes) when their extension is .npz, text otherwise """
+    return path.endswith(".npz")
+
+
+def index_codes(sample_codes):
+    """ convert codes to IndexedCodes, samples in the sorted order of the text format """
+    feature_index = {}
+    samples = sorted(sample_codes)
+    offsets = np.zeros(len(samples) + 1, dtype=np.int64)
+    indices = []
+    for number, sample in enumerate(samples):
+        code = sample_codes[sample] or []
+        indices += [feature_index.setdefault(feature, len(feature_index)) for feature in code]
+        offsets[number + 1] = len(indices)
+    return IndexedCodes(
+        features=list(feature_index),
+        samples=samples,
+        offsets=offsets,
+        indices=np.array(indices, dtype=np.int32),
+        missing=np.array([sample_codes[sample] is None for sample in samples], dtype=bool),
+    )
+
+
+def unindex_codes(indexed_codes):
+    """ convert IndexedCodes back to codes """
+    features = indexed_codes.features
+    offsets, indices = indexed_codes.offsets.tolist(), indexed_codes.indices.tolist()
+    sample_codes = {}
+    for number, sample in enumerate(indexed_codes.samples):
+        sample_codes[sample] = None if indexed_codes.missing[number] else \
+            [features[index] for index in indices[offsets[number]:offsets[number + 1]]]
+    return sample_codes
+
+
+def pack_names(names):
+    """ names as the utf-8 bytes of one newline-separated string (names never contain newlines) """
+    return np.frombuffer("\n".join(names).encode("utf-8"), dtype=np.uint8)
 
-            if len(hits) == 0 and sample not in codes_samples:
-                key = "6|TN"
 
-            counts[key] += 1
-    return counts
+def unpack_names(packed):
+    """ reverse of pack_names """
+    return packed.tobytes().decode("utf-8").split("\n") if len(packed) > 0 else []
 
 
+def write_indexed_codes(indexed_codes, path):
+    """ write IndexedCodes to a binary .npz file """
+    with try_open(path, "wb") as fh:
+        np.savez(
+            fh,
+            features=pack_names(indexed_codes.features),
+            samples=pack_names(indexed_codes.samples),
+            offsets=indexed_codes.offsets,
+            indices=indexed_codes.indices,
+            missing=indexed_codes.missing,
+        )
+
+
+def read_indexed_codes(path):
+    """ read the IndexedCodes of a binary codes file without converting them to names """
+    with np.load(path) as npz:
+        return IndexedCodes(
+            features=unpack_names(npz["features"]),
+            samples=unpack_names(npz["samples"]),
+            offsets=npz["offsets"],
+            indices=npz["indices"],
+            missing=npz["missing"],
+        )
+
+
+@profiled("write")
 def write_codes(sample_codes, path):
-    """ write code sets to a text file """
+    """ write code sets to a text file (or a binary file, see is_binary_codes) """
+    if is_binary_codes(path):
+        write_indexed_codes(index_codes(sample_codes), path)
+        print("wrote codes to:", path)
+        return
     with try_open(path, "w") as fh:
         print("#SAMPLE\tCODE", file=fh)
         for sample in sorted(sample_codes):
@@ -308,6 +729,8 @@ def write_codes(sample_codes, path):
 
 def read_codes(path):
     """ read back in the codes written by write_codes """
+    if is_binary_codes(path):
+        return unindex_codes(read_indexed_codes(path))
     sample_codes = {}
     with try_open(path) as fh:
         fh.readline()  # headers
@@ -318,6 +741,7 @@ def read_codes(path):
     return sample_codes
 
 
+@profiled("write")
 def write_hits(sample_hits, sample_codes, path):
     """ write hit results and summary to a text file """
     # compute confusion line
@@ -338,6 +762,36 @@ def write_hits(sample_hits, sample_codes, path):
     print("wrote hits to:", path)
 
 
+@profiled("write")
+def write_evaluations(evaluations, path):
+    """
+    write the hits of several evaluations to one tab-delimited file, one row per
+    evaluation and sample with its confusion class and hits (comma-separated)
+    evaluations: list of (code table name, eval table name, sample_hits, sample_codes)
+    """
+    with try_open(path, "w") as fh:
+        print("\t".join(["code_table", "eval_table", "sample", "class", "hits"]), file=fh)
+        for code_name, eval_name, sample_hits, sample_codes in evaluations:
+            matrix = hit_matrix(sample_hits)
+            classes = hit_classes(matrix, sample_codes).tolist()
+            for i in sorted(range(len(matrix.samples)), key=matrix.samples.__getitem__):
+                hits = sample_hits[matrix.samples[i]] or []
+                print("\t".join([code_name, eval_name, matrix.samples[i], c_confusion_classes[classes[i]],
+                                 ",".join(hits)]), file=fh)
+    print("wrote evaluations to:", path)
+
+
+@profiled("write")
+def write_thresholds(threshold_confusions, path):
+    """ write confusion counts per abund_detect threshold to a text file """
+    classes = sorted(next(iter(threshold_confusions.values()), {}))
+    with try_open(path, "w") as fh:
+        print("\t".join(["#THRESHOLD"] + classes), file=fh)
+        for threshold, confusion in threshold_confusions.items():
+            print("\t".join([repr(threshold)] + [str(confusion[k]) for k in classes]), file=fh)
+    print("wrote threshold counts to:", path)
+
+
 # ---------------------------------------------------------------------------
 # encode part
 # ---------------------------------------------------------------------------
@@ -349,20 +803,58 @@ def jaccard(set1, set2):
     return count_intersection / float(count_union)
 
 
+def abundance_gaps(fsv, abund_nondetect):
+    """
+    gap between each sample's value and the next-lower value of the same feature
+    (or abund_nondetect if there is none), returns sample->feature->gap
+    """
+    feature_ids, values, pairs = [], [], []
+    for feature_id, (feature, sdict) in enumerate(fsv.items()):
+        for sample, value in sdict.items():
+            feature_ids.append(feature_id)
+            values.append(value)
+            pairs.append((sample, feature))
+    gaps = abundance_gap_values(np.array(feature_ids, dtype=np.int64), np.array(values, dtype=np.float64),
+                                abund_nondetect)
+    sample_gaps = {}
+    for (sample, feature), gap in zip(pairs, gaps.tolist()):
+        sample_gaps.setdefault(sample, {})[feature] = gap
+    return sample_gaps
+
+
+def abundance_gap_values(feature_ids, values, abund_nondetect):
+    """ abundance gaps of (feature id, value) entries as an array in entry order """
+    # sort each feature column once, ascending by value
+    order = np.lexsort((values, feature_ids))
+    sorted_ids, sorted_values = feature_ids[order], values[order]
+    same_prev = np.zeros(len(order), dtype=bool)
+    same_prev[1:] = sorted_ids[1:] == sorted_ids[:-1]
+    tied_prev = same_prev.copy()
+    tied_prev[1:] &= sorted_values[1:] == sorted_values[:-1]
+    tied = tied_prev.copy()
+    tied[:-1] |= tied_prev[1:]
+    # another sample with the same value leaves no gap
+    lesser = np.full(len(order), -np.inf)
+    lesser[1:] = np.where(same_prev[1:], sorted_values[:-1], -np.inf)
+    lesser = np.where(tied, sorted_values, lesser)
+    gaps = np.empty(len(order))
+    gaps[order] = sorted_values - np.maximum(lesser, abund_nondetect)
+    return gaps
+
+
+@profiled("rank")
 def rank_by_abundgap(sfv, fsv, abund_nondetect):
     """ abundance gap sorting sfv features """
+    sample_gaps = abundance_gaps(fsv, abund_nondetect)
     sorted_features = {}
     for sample, fdict in sfv.items():
-        gaps = {}
-        for feature, focal_value in fdict.items():
-            lesser_values = [abund_nondetect]
-            lesser_values += [value for sample2, value in fsv[feature].items() \
-                              if value <= focal_value and sample2 != sample]
-            gaps[feature] = focal_value - max(lesser_values)
-        sorted_features[sample] = sorted(gaps, key=lambda feature: gaps[feature])
+        features = list(fdict)
+        gaps = np.array([sample_gaps[sample][feature] for feature in features], dtype=np.float64)
+        sorted_features[sample] = [features[i] for i in np.argsort(gaps, kind="stable")]
     return sorted_features
 
 
+@profiled("rank")
 def rank_by_rarity(sfv, fsv, abund_nondetect):
     """ rarity sorting of sfv features """
     sorted_features = {}
@@ -375,9 +867,140 @@ def rank_by_rarity(sfv, fsv, abund_nondetect):
     return sorted_features
 
 
+def incidence_rows(fsv_sets):
+    """ feature x sample incidence as CSR-style arrays (indptr, sample indices) """
+    sample_index = {}
+    indptr, indices = [0], []
+    for samples in fsv_sets.values():
+        indices += [sample_index.setdefault(sample2, len(sample_index)) for sample2 in samples]
+        indptr.append(len(indices))
+    return np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int64), len(sample_index)
+
+
+def sort_rows(indptr, indices, order):
+    """ CSR-style arrays with their rows in the given order """
+    lengths = np.diff(indptr)[order]
+    sorted_indptr = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=sorted_indptr[1:])
+    positions = np.arange(sorted_indptr[-1], dtype=np.int64) + \
+        np.repeat(indptr[:-1][order] - sorted_indptr[:-1], lengths)
+    return sorted_indptr, indices[positions]
+
+
+def dense_rows(indptr, indices, start, stop, n_samples):
+    """ dense float32 incidence of the rows start:stop of CSR-style arrays """
+    block = np.zeros((stop - start, n_samples), dtype=np.float32)
+    block[np.repeat(np.arange(stop - start), np.diff(indptr[start:stop + 1])), \
+          indices[indptr[start]:indptr[stop]]] = 1
+    return block
+
+
+def similar_pairs_exact(indptr, indices, n_samples, similarity_cutoff):
+    """
+    all feature pairs with jaccard >= cutoff, from products of dense blocks of the incidence rows
+    features are sorted by size: jaccard >= cutoff needs cutoff * larger size <= smaller size,
+    so each block is only multiplied with itself and the following blocks within that range
+    """
+    n_features = len(indptr) - 1
+    order = np.argsort(np.diff(indptr), kind="stable")
+    indptr, indices = sort_rows(indptr, indices, order)
+    sizes = np.diff(indptr)
+    pairs = []
+    for start in range(0, n_features, c_similarity_block):
+        stop = min(start + c_similarity_block, n_features)
+        # sizes are integers, the margin only guards the float comparison
+        limit = int(np.searchsorted(sizes * similarity_cutoff, sizes[stop - 1] + 1e-6, side="right")) \
+            if similarity_cutoff > 0 else n_features
+        block = dense_rows(indptr, indices, start, stop, n_samples)
+        for start2 in range(start, max(limit, stop), c_similarity_block):
+            stop2 = min(start2 + c_similarity_block, n_features)
+            block2 = block if start2 == start else dense_rows(indptr, indices, start2, stop2, n_samples)
+            intersections = (block @ block2.T).astype(np.int64)
+            unions = sizes[start:stop, None] + sizes[None, start2:stop2] - intersections
+            rows, cols = np.nonzero(intersections / unions.astype(np.float64) >= similarity_cutoff)
+            pairs.append((rows + start, cols + start2))
+            if start2 != start:
+                pairs.append((cols + start2, rows + start))
+    rows = np.concatenate([pair[0] for pair in pairs]) if pairs else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate([pair[1] for pair in pairs]) if pairs else np.zeros(0, dtype=np.int64)
+    return order[rows], order[cols]
+
+
+def minhash_bands(similarity_cutoff, permutations=c_minhash_permutations):
+    """ choose LSH bands x rows so the detection threshold sits just below the cutoff """
+    best = (permutations, 1)
+    for rows in range(1, permutations + 1):
+        bands = permutations // rows
+        threshold = (1.0 / bands) ** (1.0 / rows)
+        if threshold <= similarity_cutoff:
+            best = (bands, rows)
+    return best
+
+
+def similar_pairs_minhash(indptr, indices, n_samples, similarity_cutoff, fsv_sets):
+    """
+    feature pairs with jaccard >= cutoff among MinHash/LSH candidates
+    candidates are verified exactly, so pairs can be missed but never invented
+    """
+    n_features = len(indptr) - 1
+    prime = (1 << 31) - 1
+    rng = np.random.RandomState(c_minhash_seed)
+    a = rng.randint(1, prime, size=(c_minhash_permutations, 1)).astype(np.int64)
+    b = rng.randint(0, prime, size=(c_minhash_permutations, 1)).astype(np.int64)
+    hashed = (a * np.arange(n_samples, dtype=np.int64)[None, :] + b) % prime
+    # signatures of a chunk of features at a time, each chunk gathers at most c_minhash_chunk hashes per permutation
+    signatures = np.zeros((n_features, c_minhash_permutations), dtype=np.int64)
+    start = 0
+    while start < n_features:
+        stop = max(start + 1, int(np.searchsorted(indptr, indptr[start] + c_minhash_chunk, side="right")) - 1)
+        stop = min(stop, n_features)
+        chunk = hashed[:, indices[indptr[start]:indptr[stop]]]
+        signatures[start:stop] = np.minimum.reduceat(chunk, indptr[start:stop] - indptr[start], axis=1).T
+        start = stop
+    bands, rows = minhash_bands(similarity_cutoff)
+    candidates = set()
+    for band in range(bands):
+        _, buckets = np.unique(signatures[:, band * rows:(band + 1) * rows], axis=0, return_inverse=True)
+        buckets = buckets.ravel()
+        order = np.argsort(buckets, kind="stable")
+        bounds = np.flatnonzero(np.diff(buckets[order])) + 1
+        for group in np.split(order, bounds):
+            if len(group) > 1:
+                group = group.tolist()
+                candidates.update((i, j) for k, i in enumerate(group) for j in group[k + 1:])
+    features = list(fsv_sets)
+    similar = [(i, j) for i, j in candidates \
+               if jaccard(fsv_sets[features[i]], fsv_sets[features[j]]) >= similarity_cutoff]
+    similar += [(i, i) for i in range(n_features) if similarity_cutoff <= 1]
+    rows = np.array([i for i, j in similar] + [j for i, j in similar if i != j], dtype=np.int64)
+    cols = np.array([j for i, j in similar] + [i for i, j in similar if i != j], dtype=np.int64)
+    return rows, cols
+
+
+@profiled("similarity")
+def similarity_index(fsv_sets, similarity_cutoff, method="exact"):
+    """
+    build once per table: feature -> set of features with jaccard >= similarity_cutoff
+    used by make_one_code as a neighbor lookup instead of rescanning all features
+    """
+    indptr, indices, n_samples = incidence_rows(fsv_sets)
+    if method == "minhash":
+        rows, cols = similar_pairs_minhash(indptr, indices, n_samples, similarity_cutoff, fsv_sets)
+    else:
+        rows, cols = similar_pairs_exact(indptr, indices, n_samples, similarity_cutoff)
+    features = list(fsv_sets)
+    similar_features = {feature: set() for feature in features}
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        similar_features[features[i]].add(features[j])
+    return similar_features
+
+
 def make_one_code(sample, ranked_features, sfv_sets, fsv_sets, \
-                  similarity_cutoff, min_code_size):
-    """ execute the idabilty algorithm for one sample """
+                  similarity_cutoff, min_code_size, similar_features=None):
+    """
+    execute the idabilty algorithm for one sample
+    similar_features (feature->similar features) replaces the jaccard rescan if given
+    """
     features = ranked_features[:]
     other_samples = {sample2 for sample2 in sfv_sets if sample2 != sample}
     code = []
@@ -394,15 +1017,141 @@ def make_one_code(sample, ranked_features, sfv_sets, fsv_sets, \
         if old_count == new_count and old_count != 0:
             code.pop()
         # restrict remaining features to avoid similarity to best feature
-        if similarity_cutoff is not None:
+        if similar_features is not None:
+            knockouts = similar_features[feature]
+            features = [feature2 for feature2 in features if feature2 not in knockouts]
+        elif similarity_cutoff is not None:
             features = [feature2 for feature2 in features \
                         if jaccard(fsv_sets[feature], fsv_sets[feature2]) \
                         < similarity_cutoff]
     return code if len(other_samples) == 0 else None
 
 
-def encode_all(sfv, abund_detect, abund_nondetect, similarity_cutoff, min_code_size, ranking="rarity"):
-    """ run idability algorithm on all samples """
+def popcount(bits):
+    """ number of set bits in a packed bit array """
+    return int(c_popcount[bits].sum())
+
+
+def jaccard_bits(bits1, bits2):
+    """ jaccard similarity for two packed bit arrays """
+    count_union = popcount(np.bitwise_or(bits1, bits2))
+    count_intersection = popcount(np.bitwise_and(bits1, bits2))
+    return count_intersection / float(count_union)
+
+
+def index_sets(sfv_sets, fsv_sets):
+    """
+    map samples and features to integer indices and pack each
+    feature's sample set into a bit array (fsv_bits: feature index -> bits)
+    """
+    sample_index = {sample: i for i, sample in enumerate(sfv_sets)}
+    feature_index = {feature: i for i, feature in enumerate(fsv_sets)}
+    incidence = np.zeros((len(feature_index), len(sample_index)), dtype=bool)
+    for feature, samples in fsv_sets.items():
+        incidence[feature_index[feature], [sample_index[sample2] for sample2 in samples]] = True
+    fsv_bits = np.packbits(incidence, axis=1)
+    return sample_index, feature_index, fsv_bits
+
+
+def make_one_code_bitset(sample_number, n_samples, ranked_features, feature_index, fsv_bits, \
+                         similarity_cutoff, min_code_size, similar_features=None):
+    """
+    execute the idabilty algorithm for one sample on packed bit arrays
+    similar_features is keyed by feature index, returns the code as feature indices
+    """
+    features = [feature_index[feature] for feature in ranked_features]
+    others = np.ones(n_samples, dtype=bool)
+    others[sample_number] = False
+    other_samples = np.packbits(others)
+    other_count = popcount(other_samples)
+    code = []
+    while len(features) > 0 and \
+            (other_count > 0 or len(code) < min_code_size):
+        feature = features.pop()
+        code.append(feature)
+        # restrict other samples
+        old_count = other_count
+        other_samples = np.bitwise_and(other_samples, fsv_bits[feature])
+        other_count = popcount(other_samples)
+        # forget current feature if it doesn't knock out 1+ additions samples
+        # *** unless we've already knocked everyone out and are just lengthening code ***
+        if old_count == other_count and old_count != 0:
+            code.pop()
+        # restrict remaining features to avoid similarity to best feature
+        if similar_features is not None:
+            knockouts = similar_features[feature]
+            features = [feature2 for feature2 in features if feature2 not in knockouts]
+        elif similarity_cutoff is not None:
+            features = [feature2 for feature2 in features \
+                        if jaccard_bits(fsv_bits[feature], fsv_bits[feature2]) \
+                        < similarity_cutoff]
+    return code if other_count == 0 else None
+
+
+def encode_samples(samples, state):
+    """ make codes for the given samples from a prepared encode state """
+    codes = []
+    for sample in samples:
+        if state["engine"] == "bitset":
+            code = make_one_code_bitset(
+                state["sample_index"][sample],
+                len(state["sample_index"]),
+                state["sorted_features"][sample],
+                state["feature_index"],
+                state["fsv_bits"],
+                state["similarity_cutoff"],
+                state["min_code_size"],
+                state["similar_features"],
+            )
+            feature_names = state["feature_names"]
+            codes.append(None if code is None else [feature_names[feature] for feature in code])
+        else:
+            codes.append(make_one_code(
+                sample,
+                state["sorted_features"][sample],
+                state["sfv_sets"],
+                state["fsv_sets"],
+                state["similarity_cutoff"],
+                state["min_code_size"],
+                state["similar_features"],
+            ))
+    return codes
+
+
+# read-only encode state of a worker process, inherited on fork or set once by init_encode_worker
+encode_state = {}
+
+
+def init_encode_worker(state):
+    """ receive the encode state once per worker process """
+    encode_state.update(state)
+
+
+def encode_chunk(samples):
+    """ worker entry point: encode a chunk of samples """
+    return encode_samples(samples, encode_state)
+
+
+def encode_parallel(samples, state, jobs):
+    """ spread samples over a process pool, results come back in sample order """
+    chunk_size = max(1, -(-len(samples) // (jobs * 4)))
+    chunks = [samples[i:i + chunk_size] for i in range(0, len(samples), chunk_size)]
+    if "fork" in multiprocessing.get_all_start_methods():
+        # workers inherit the state from this process, nothing is pickled per task
+        context, initializer, initargs = multiprocessing.get_context("fork"), None, ()
+        encode_state.update(state)
+    else:
+        context, initializer, initargs = multiprocessing.get_context(), init_encode_worker, (state,)
+    try:
+        with context.Pool(jobs, initializer=initializer, initargs=initargs) as pool:
+            results = pool.map(encode_chunk, chunks)
+    finally:
+        encode_state.clear()
+    return [code for chunk_codes in results for code in chunk_codes]
+
+
+def prepare_encode(sfv, abund_detect, abund_nondetect, similarity_cutoff, ranking="rarity", jaccard_index="exact"):
+    """ rank features and reduce sfv/fsv to sets, returns everything make_all_codes needs """
     # flip sfv to fsv
     fsv = flip_sfv(sfv)
     # rebuild sfv with only features above abund threshold
@@ -414,18 +1163,145 @@ def encode_all(sfv, abund_detect, abund_nondetect, similarity_cutoff, min_code_s
     # simplify sfv and fsv to sets
     sfv_sets = coerce_to_sets(sfv)
     fsv_sets = coerce_to_sets(fsv)
+    # find similar features once for the whole table
+    similar_features = None
+    if similarity_cutoff is not None:
+        print("building feature similarity index:", jaccard_index)
+        similar_features = similarity_index(fsv_sets, similarity_cutoff, method=jaccard_index)
+    return sorted_features, sfv_sets, fsv_sets, similar_features
+
+
+def name_set(names, shared=False):
+    """ set (frozenset if shared) of names, built like coerce_to_sets so iteration order matches """
+    return (frozenset if shared else set)(dict.fromkeys(names))
+
+
+@profiled("reduce")
+def table_entries(table, abund_detect, abund_nondetect, keep_values=True):
+    """
+    entries of a table above abund_nondetect as (feature rows, sample columns, values),
+    the entries above abund_detect (sorted by sample column) and the feature prevalence.
+    without keep_values the values are None: ranking by rarity only needs which entries are present
+    """
+    rows = np.repeat(np.arange(len(table.features), dtype=np.int32), np.diff(table.indptr))
+    keep = table.data >= abund_nondetect
+    detect = np.flatnonzero((table.data >= abund_detect)[keep])
+    rows, cols = rows[keep], table.indices[keep].astype(np.int32)
+    values = table.data[keep] if keep_values else None
+    prevalence = np.bincount(rows, minlength=len(table.features))
+    detect = detect[np.argsort(cols[detect], kind="stable")]
+    return (rows, cols, values), detect, prevalence
+
+
+@profiled("flip")
+def table_fsv_sets(table, entries, prevalence):
+    """
+    fsv_sets of the entries of table_entries. a prevalence pre-pass gives features present in
+    every sample one shared frozenset of all samples and builds the set of single-sample features directly
+    """
+    rows, cols = entries[:2]
+    features, samples = np.array(table.features, dtype=object), table.samples
+    # fsv order: features by first sample, then by row (rows are grouped, columns ascending)
+    starts = np.concatenate([[0], np.cumsum(prevalence)])
+    present = np.flatnonzero(prevalence)
+    sample_names = np.array(samples, dtype=object)
+    all_samples = name_set(samples, shared=True)
+    fsv_sets = {}
+    for row in present[np.lexsort((present, cols[starts[present]]))].tolist():
+        if prevalence[row] == len(samples):
+            fsv_sets[features[row]] = all_samples
+        elif prevalence[row] == 1:
+            fsv_sets[features[row]] = {sample_names[cols[starts[row]]]}
+        else:
+            fsv_sets[features[row]] = name_set(sample_names[cols[starts[row]:starts[row + 1]]].tolist())
+    return fsv_sets
+
+
+@profiled("rank")
+def rank_table(table, entries, detect, prevalence, abund_nondetect, ranking="rarity"):
+    """
+    rank_by_rarity/rank_by_abundgap on the entries of table_entries: ties keep
+    feature row order, like the stable sorts over sfv
+    """
+    rows, cols, values = entries
+    if ranking == "rarity":
+        keys = -prevalence[rows[detect]]
+    else:
+        # gaps to the next-lower value among all entries above abund_nondetect
+        keys = abundance_gap_values(rows, values, abund_nondetect)[detect]
+    # detect is sorted by sample column and feature row, a stable sort keeps that order for ties
+    order = detect[np.lexsort((keys, cols[detect]))]
+    sample_starts = np.searchsorted(cols[order], np.arange(len(table.samples) + 1))
+    ranked = np.array(table.features, dtype=object)[rows[order]]
+    return {sample: ranked[sample_starts[col]:sample_starts[col + 1]].tolist()
+            for col, sample in enumerate(table.samples)}
+
+
+def prepare_encode_table(table, abund_detect, abund_nondetect, similarity_cutoff, ranking="rarity",
+                         jaccard_index="exact"):
+    """
+    same as prepare_encode(table_to_sfv(table, abund_nondetect), ...), but without the
+    nested dicts of python floats: values stay in numpy arrays and are dropped once the
+    features are ranked (rarity never keeps them). make_all_codes only needs the samples
+    of sfv_sets, so the samples are returned in its place and only fsv_sets are built
+    """
+    entries, detect, prevalence = table_entries(table, abund_detect, abund_nondetect,
+                                                keep_values=ranking != "rarity")
+    print("performing requested feature ranking:", ranking)
+    sorted_features = rank_table(table, entries, detect, prevalence, abund_nondetect, ranking=ranking)
+    entries = entries[:2]
+    del detect
+    fsv_sets = table_fsv_sets(table, entries, prevalence)
+    del entries
+    similar_features = None
+    if similarity_cutoff is not None:
+        print("building feature similarity index:", jaccard_index)
+        similar_features = similarity_index(fsv_sets, similarity_cutoff, method=jaccard_index)
+    return sorted_features, list(table.samples), fsv_sets, similar_features
+
+
+def encode_all(sfv, abund_detect, abund_nondetect, similarity_cutoff, min_code_size, ranking="rarity",
+               engine="sets", jaccard_index="exact", jobs=1):
+    """ run idability algorithm on all samples """
+    sorted_features, sfv_sets, fsv_sets, similar_features = prepare_encode(
+        sfv, abund_detect, abund_nondetect, similarity_cutoff, ranking=ranking, jaccard_index=jaccard_index)
+    return make_all_codes(sorted_features, sfv_sets, fsv_sets, similarity_cutoff, min_code_size,
+                          similar_features, engine=engine, jobs=jobs)
+
+
+@profiled("encode")
+def make_all_codes(sorted_features, sfv_sets, fsv_sets, similarity_cutoff, min_code_size, \
+                   similar_features=None, engine="sets", jobs=1, samples=None):
+    """
+    make codes for each sample (or only the given samples)
+    once features are ranked and reduced to sets
+    only the samples of sfv_sets are used, a list of samples is enough
+    """
+    state = {
+        "engine": engine,
+        "sorted_features": sorted_features,
+        "similarity_cutoff": similarity_cutoff,
+        "min_code_size": min_code_size,
+        "similar_features": similar_features,
+    }
+    if engine == "bitset":
+        print("indexing samples and features as bit arrays")
+        sample_index, feature_index, fsv_bits = index_sets(sfv_sets, fsv_sets)
+        if similar_features is not None:
+            state["similar_features"] = {feature_index[feature]: {feature_index[feature2] for feature2 in similar} \
+                                         for feature, similar in similar_features.items()}
+        state.update(sample_index=sample_index, feature_index=feature_index, fsv_bits=fsv_bits,
+                     feature_names=list(feature_index))
+    else:
+        state.update(sfv_sets=sfv_sets, fsv_sets=fsv_sets)
     # make codes for each sample
-    sample_codes = {}
-    for i, sample in enumerate(sfv_sets):
-        sample_codes[sample] = make_one_code(
-            sample,
-            sorted_features[sample],
-            sfv_sets,
-            fsv_sets,
-            similarity_cutoff,
-            min_code_size,
-        )
-    return sample_codes
+    samples = list(sfv_sets) if samples is None else list(samples)
+    if jobs > 1 and len(samples) > 1:
+        print("encoding samples with %d processes" % jobs)
+        codes = encode_parallel(samples, state, jobs)
+    else:
+        codes = encode_samples(samples, state)
+    return dict(zip(samples, codes))
 
 
 # ---------------------------------------------------------------------------
@@ -442,14 +1318,443 @@ def check_one_code(code, sfv_sets):
     return hits
 
 
+@profiled("decode")
+def build_postings(sfv_sets):
+    """ inverted index of a population: feature -> sorted array of sample indices """
+    postings = {}
+    for sample_number, features_set in enumerate(sfv_sets.values()):
+        for feature in features_set:
+            postings.setdefault(feature, []).append(sample_number)
+    return {feature: np.array(numbers, dtype=np.int64) for feature, numbers in postings.items()}
+
+
+def code_hits(code, postings, n_samples):
+    """ sample indices hit by a code: intersects the postings of the code's features """
+    return intersect_postings([postings.get(feature) for feature in set(code)], n_samples)
+
+
+def intersect_postings(code_postings, n_samples):
+    """
+    sample indices in all postings of a code (rarest first, stopping as soon as
+    nothing is left), None stands for a feature missing from the population
+    """
+    if len(code_postings) == 0:
+        return np.arange(n_samples, dtype=np.int64)
+    if any(posting is None for posting in code_postings):
+        return np.zeros(0, dtype=np.int64)
+    code_postings = sorted(code_postings, key=len)
+    hits = code_postings[0]
+    for posting in code_postings[1:]:
+        if len(hits) == 0:
+            break
+        hits = np.intersect1d(hits, posting, assume_unique=True)
+    return hits
+
+
+def check_one_code_indexed(code, postings, samples):
+    """ same as check_one_code, but with the postings of the population """
+    return [samples[sample_number] for sample_number in code_hits(code, postings, len(samples)).tolist()]
+
+
+# hits of all codes as a sparse boolean matrix: the code of samples[i] hits the table samples
+# indices[indptr[i]:indptr[i + 1]]; coded[i] is False for samples without a code (hits None)
+HitMatrix = namedtuple("HitMatrix", ["samples", "table_samples", "indptr", "indices", "coded"])
+
+
+def hit_matrix(sample_hits):
+    """ HitMatrix of hits given as lists of sample names (columns: the samples, then other hit samples) """
+    samples = list(sample_hits)
+    column = {sample: i for i, sample in enumerate(samples)}
+    coded = [hits is not None for hits in sample_hits.values()]
+    indptr = np.zeros(len(samples) + 1, dtype=np.int64)
+    np.cumsum([len(hits) if hits is not None else 0 for hits in sample_hits.values()], out=indptr[1:])
+    hit_samples = [sample2 for hits in sample_hits.values() if hits is not None for sample2 in hits]
+    if all(sample2 in column for sample2 in hit_samples):
+        indices = np.fromiter(map(column.__getitem__, hit_samples), dtype=np.int64, count=len(hit_samples))
+    else:
+        indices = np.array([column.setdefault(sample2, len(column)) for sample2 in hit_samples], dtype=np.int64)
+    return HitMatrix(
+        samples=samples,
+        table_samples=list(column),
+        indptr=indptr,
+        indices=indices,
+        coded=np.array(coded, dtype=bool),
+    )
+
+
+@profiled("decode")
+def decode_matrix(sample_codes, postings, table_samples):
+    """ compare all codes to a population given as postings over table_samples, returns a HitMatrix """
+    samples = list(dict.fromkeys(list(table_samples) + list(sample_codes)))
+    coded = np.array([sample_codes.get(sample) is not None for sample in samples], dtype=bool)
+    hits = [code_hits(sample_codes[sample], postings, len(table_samples)) if coded[i] else np.zeros(0, dtype=np.int64)
+            for i, sample in enumerate(samples)]
+    indptr = np.zeros(len(samples) + 1, dtype=np.int64)
+    np.cumsum([len(sample_hits) for sample_hits in hits], out=indptr[1:])
+    return HitMatrix(
+        samples=samples,
+        table_samples=list(table_samples),
+        indptr=indptr,
+        indices=np.concatenate(hits) if len(hits) > 0 else np.zeros(0, dtype=np.int64),
+        coded=coded,
+    )
+
+
+@profiled("decode")
+def decode_indexed_codes(indexed_codes, postings, table_samples):
+    """
+    same as decode_matrix for IndexedCodes: the postings of each feature index
+    are looked up once and the codes are read from indices/offsets
+    """
+    feature_postings = [postings.get(feature) for feature in indexed_codes.features]
+    code_numbers = {sample: number for number, sample in enumerate(indexed_codes.samples)}
+    samples = list(dict.fromkeys(list(table_samples) + list(indexed_codes.samples)))
+    offsets = indexed_codes.offsets.tolist()
+    coded = np.zeros(len(samples), dtype=bool)
+    hits = []
+    for i, sample in enumerate(samples):
+        number = code_numbers.get(sample)
+        if number is None or indexed_codes.missing[number]:
+            hits.append(np.zeros(0, dtype=np.int64))
+            continue
+        coded[i] = True
+        code = set(indexed_codes.indices[offsets[number]:offsets[number + 1]].tolist())
+        hits.append(intersect_postings([feature_postings[index] for index in code], len(table_samples)))
+    indptr = np.zeros(len(samples) + 1, dtype=np.int64)
+    np.cumsum([len(sample_hits) for sample_hits in hits], out=indptr[1:])
+    return HitMatrix(
+        samples=samples,
+        table_samples=list(table_samples),
+        indptr=indptr,
+        indices=np.concatenate(hits) if len(hits) > 0 else np.zeros(0, dtype=np.int64),
+        coded=coded,
+    )
+
+
+def matrix_hits(matrix):
+    """ hits of a HitMatrix as lists of sample names (None for samples without a code) """
+    names = np.array(matrix.table_samples, dtype=object)
+    indptr = matrix.indptr.tolist()
+    return {sample: names[matrix.indices[indptr[i]:indptr[i + 1]]].tolist() if matrix.coded[i] else None
+            for i, sample in enumerate(matrix.samples)}
+
+
+def hit_classes(matrix, sample_codes):
+    """
+    confusion class of every row of a HitMatrix (index into c_confusion_classes):
+    TP if the code hits its own sample, FP if it hits any other, TN for samples
+    without a code that are not in sample_codes, NA for samples whose code is None
+    """
+    if isinstance(sample_codes, IndexedCodes):
+        sample_codes = set(sample_codes.samples)
+    column = {sample: i for i, sample in enumerate(matrix.table_samples)}
+    own_columns = np.array([column.get(sample, -1) for sample in matrix.samples], dtype=np.int64)
+    hit_counts = np.diff(matrix.indptr)
+    rows = np.repeat(np.arange(len(matrix.samples)), hit_counts)
+    own_hits = matrix.indices == own_columns[rows]
+    tp_hit = np.bincount(rows[own_hits], minlength=len(matrix.samples)) > 0
+    fp_hit = np.bincount(rows[~own_hits], minlength=len(matrix.samples)) > 0
+    in_codes = np.array([sample in sample_codes for sample in matrix.samples], dtype=bool)
+    classes = np.select(
+        [~matrix.coded & in_codes, ~in_codes & (~matrix.coded | (hit_counts == 0)),
+         tp_hit & ~fp_hit, tp_hit & fp_hit, fp_hit],
+        [c_confusion_classes.index(k) for k in ["5|NA", "6|TN", "1|TP", "2|TP+FP", "3|FN+FP"]],
+        default=c_confusion_classes.index("4|FN"),
+    )
+    return classes
+
+
+def hit_confusion(matrix, sample_codes):
+    """ check_hits counts of a HitMatrix """
+    counts = np.bincount(hit_classes(matrix, sample_codes), minlength=len(c_confusion_classes))
+    return dict(zip(c_confusion_classes, counts.tolist()))
+
+
+def decode_indexed(sample_codes, postings, table_samples):
+    """ compare all codes to a population given as postings over table_samples """
+    return matrix_hits(decode_matrix(sample_codes, postings, table_samples))
+
+
 def decode_all(sfv, sample_codes, abund_detect):
-    """ compare all codes to a population """
+    """ compare all codes (or IndexedCodes) to a population """
     sfv_sets = coerce_to_sets(reduce_sfv(sfv, abund_detect))
-    table_samples = sfv_sets.keys()
-    sample_hits = dict.fromkeys(table_samples)
-    for sample, code in sample_codes.items():
-        sample_hits[sample] = None if code is None else check_one_code(code, sfv_sets)
-    return sample_hits
+    if isinstance(sample_codes, IndexedCodes):
+        return matrix_hits(decode_indexed_codes(sample_codes, build_postings(sfv_sets), list(sfv_sets)))
+    return decode_indexed(sample_codes, build_postings(sfv_sets), list(sfv_sets))
+
+
+@profiled("decode")
+def code_min_abundance(table, sample_codes, abund_nondetect):
+    """
+    minimum abundance of each code's features in each table sample, values below
+    abund_nondetect count as missing (-inf); returns the coded samples and a
+    coded samples x table samples matrix
+    """
+    feature_rows = {feature: row for row, feature in enumerate(table.features)}
+    missing = 0.0 if 0.0 >= abund_nondetect else -np.inf
+    coded = [sample for sample, code in sample_codes.items() if code is not None]
+    minimum = np.full((len(coded), len(table.samples)), np.inf)
+    for i, sample in enumerate(coded):
+        for feature in set(sample_codes[sample]):
+            values = np.full(len(table.samples), -np.inf)
+            if feature in feature_rows:
+                row = feature_rows[feature]
+                start, stop = table.indptr[row], table.indptr[row + 1]
+                data = table.data[start:stop]
+                values[:] = missing
+                values[table.indices[start:stop]] = np.where(data >= abund_nondetect, data, -np.inf)
+            np.minimum(minimum[i], values, out=minimum[i])
+    return coded, minimum
+
+
+@profiled("decode")
+def threshold_confusions(sample_codes, table_samples, coded, minimum, thresholds):
+    """
+    check_hits counts for every abund_detect threshold: a code hits a sample
+    at threshold t exactly when its minimum abundance in that sample is >= t
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    column = {sample: i for i, sample in enumerate(table_samples)}
+    counts = {k: np.zeros(len(thresholds), dtype=np.int64) for k in c_confusion_classes}
+    counts["5|NA"] += sum(1 for code in sample_codes.values() if code is None)
+    counts["6|TN"] += sum(1 for sample in table_samples if sample not in sample_codes)
+    for i, sample in enumerate(coded):
+        sorted_minimum = np.sort(minimum[i])
+        hit_counts = len(sorted_minimum) - np.searchsorted(sorted_minimum, thresholds, side="left")
+        tp_hit = minimum[i, column[sample]] >= thresholds if sample in column \
+            else np.zeros(len(thresholds), dtype=bool)
+        fp_hit = hit_counts - tp_hit > 0
+        counts["1|TP"] += tp_hit & ~fp_hit
+        counts["2|TP+FP"] += tp_hit & fp_hit
+        counts["3|FN+FP"] += ~tp_hit & fp_hit
+        counts["4|FN"] += ~tp_hit & ~fp_hit
+    return {threshold: {k: int(v[t]) for k, v in counts.items()} for t, threshold in enumerate(thresholds.tolist())}
+
+
+# ---------------------------------------------------------------------------
+# update part
+# ---------------------------------------------------------------------------
+
+def merge_tables(old_table, new_table):
+    """
+    append the samples of new_table to old_table; features keep the old table's
+    order, features only found in new_table are added at the end
+    """
+    overlap = set(old_table.samples).intersection(new_table.samples)
+    assert len(overlap) == 0, \
+        "samples already in the old table: %s" % ", ".join(sorted(overlap))
+    features = list(old_table.features)
+    feature_rows = {feature: row for row, feature in enumerate(features)}
+    for feature in new_table.features:
+        if feature not in feature_rows:
+            feature_rows[feature] = len(features)
+            features.append(feature)
+    old_rows = np.repeat(np.arange(len(old_table.features)), np.diff(old_table.indptr))
+    new_rows = np.array([feature_rows[feature] for feature in new_table.features], dtype=np.int64)
+    new_rows = np.repeat(new_rows, np.diff(new_table.indptr))
+    rows = np.concatenate([old_rows, new_rows])
+    cols = np.concatenate([old_table.indices, new_table.indices + len(old_table.samples)])
+    data = np.concatenate([old_table.data, new_table.data])
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(len(features) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(features)), out=indptr[1:])
+    return Table(
+        features=features,
+        samples=list(old_table.samples) + list(new_table.samples),
+        indptr=indptr,
+        indices=cols[order],
+        data=data[order],
+    )
+
+
+def pop_sequence(ranked_features, similar_features, stop_feature=None, steps=None):
+    """
+    features popped by make_one_code, which do not depend on the samples knocked out;
+    stops after stop_feature or a number of steps, returns them and the count left
+    """
+    features = ranked_features[:]
+    popped = []
+    while len(features) > 0 and (steps is None or len(popped) < steps):
+        feature = features.pop()
+        popped.append(feature)
+        if similar_features is not None:
+            knockouts = similar_features[feature]
+            features = [feature2 for feature2 in features if feature2 not in knockouts]
+        if feature == stop_feature:
+            break
+    return popped, len(features)
+
+
+def code_survives(sample, code, old_popped, merged_popped, merged_left, n_old_samples, new_samples, \
+                  old_fsv_sets, merged_fsv_sets, min_code_size):
+    """
+    replay an existing code's steps with the new samples added to the other samples
+    and check that make_one_code on the merged table would take the same decisions
+    """
+    # the popped features must not change with the rankings and similarity index
+    if merged_popped != old_popped or [feature for feature in old_popped if feature in code] != code:
+        return False
+    kept = set(code)
+    # other_samples is None until the first kept feature restricts the old samples
+    other_samples, other_count, new_others = None, n_old_samples - 1, new_samples
+    for feature in old_popped:
+        old_count = other_count + len(new_others)
+        # features dropped by the old run did not knock out any old sample
+        if feature in kept:
+            if other_samples is None:
+                other_samples = old_fsv_sets[feature] - {sample}
+            else:
+                other_samples = other_samples.__and__(old_fsv_sets[feature])
+            other_count = len(other_samples)
+        new_others = new_others.__and__(merged_fsv_sets[feature])
+        new_count = other_count + len(new_others)
+        if (old_count == new_count and old_count != 0) == (feature in kept):
+            return False
+    # the merged run has to stop at the same step, with every other sample knocked out
+    return other_count + len(new_others) == 0 and (merged_left == 0 or len(code) >= min_code_size)
+
+
+def update_all(old_sfv, merged_sfv, sample_codes, abund_detect, abund_nondetect, similarity_cutoff, min_code_size, \
+               ranking="rarity", engine="sets", jaccard_index="exact", jobs=1):
+    """
+    codes for a merged population (old_sfv plus new samples), given the codes of old_sfv
+    built with the same parameters; only the new samples and the old samples whose
+    codes would change are encoded again, the result matches encode_all(merged_sfv)
+    """
+    old_ranked, old_sfv_sets, old_fsv_sets, old_similar = prepare_encode(
+        old_sfv, abund_detect, abund_nondetect, similarity_cutoff, ranking=ranking, jaccard_index=jaccard_index)
+    merged_ranked, merged_sfv_sets, merged_fsv_sets, merged_similar = prepare_encode(
+        merged_sfv, abund_detect, abund_nondetect, similarity_cutoff, ranking=ranking, jaccard_index=jaccard_index)
+    new_samples = {sample for sample in merged_sfv_sets if sample not in old_sfv_sets}
+    kept_codes = {}
+    for sample in old_sfv_sets:
+        code = sample_codes.get(sample)
+        if code is None or len(code) == 0:
+            continue
+        old_popped, _ = pop_sequence(old_ranked[sample], old_similar, stop_feature=code[-1])
+        merged_popped, merged_left = pop_sequence(merged_ranked[sample], merged_similar, steps=len(old_popped))
+        if code_survives(sample, code, old_popped, merged_popped, merged_left, len(old_sfv_sets), new_samples,
+                         old_fsv_sets, merged_fsv_sets, min_code_size):
+            kept_codes[sample] = code
+    samples = [sample for sample in merged_sfv_sets if sample not in kept_codes]
+    print("encoding %d of %d samples again" % (len(samples), len(merged_sfv_sets)))
+    codes = make_all_codes(merged_ranked, merged_sfv_sets, merged_fsv_sets, similarity_cutoff, min_code_size,
+                           merged_similar, engine=engine, jobs=jobs, samples=samples)
+    codes.update(kept_codes)
+    return {sample: codes[sample] for sample in merged_sfv_sets}
+
+
+# ---------------------------------------------------------------
+# in-process api
+# ---------------------------------------------------------------
+
+# sample -> code (None if no unique code could be built)
+Codes = Dict[str, Optional[List[str]]]
+# sample -> samples hit by its code (None if the sample has no code)
+Hits = Dict[str, Optional[List[str]]]
+
+
+def meta_settings(meta_mode, decoding):
+    """
+    settings imposed by --meta_mode [relab/rpkm]: abund_detect, abund_nondetect,
+    similarity_cutoff, min_code_size and ranking
+    """
+    abund_detect = c_rpkm_detect if meta_mode == "rpkm" else c_relab_detect
+    abund_nondetect = abund_detect * c_nondetect_multiplier
+    # relax detection parameter in decoding step
+    abund_detect = (abund_detect * c_relax_multiplier) if decoding else abund_detect
+    return abund_detect, abund_nondetect, c_max_jaccard, c_min_code_size, "abundance_gap"
+
+
+def encode(table: Table,
+           abund_detect: float = c_epsilon,
+           abund_nondetect: float = c_epsilon,
+           similarity_cutoff: Optional[float] = None,
+           min_code_size: int = 1,
+           ranking: str = "rarity",
+           engine: str = "sets",
+           jaccard_index: str = "exact",
+           jobs: int = 1,
+           meta_mode: str = "off") -> Codes:
+    """ build codes for all samples of a loaded table """
+    if meta_mode != "off":
+        abund_detect, abund_nondetect, similarity_cutoff, min_code_size, ranking = \
+            meta_settings(meta_mode, decoding=False)
+    if abund_nondetect > 0:
+        # zeros are not stored in the table, but would pass a cutoff <= 0
+        sorted_features, samples, fsv_sets, similar_features = prepare_encode_table(
+            table, abund_detect, abund_nondetect, similarity_cutoff, ranking=ranking, jaccard_index=jaccard_index)
+        return make_all_codes(sorted_features, samples, fsv_sets, similarity_cutoff, min_code_size,
+                              similar_features, engine=engine, jobs=jobs)
+    return encode_all(
+        table_to_sfv(table, abund_nondetect),
+        abund_detect=abund_detect,
+        abund_nondetect=abund_nondetect,
+        similarity_cutoff=similarity_cutoff,
+        min_code_size=min_code_size,
+        ranking=ranking,
+        engine=engine,
+        jaccard_index=jaccard_index,
+        jobs=jobs,
+    )
+
+
+def decode(table: Table,
+           sample_codes: Union[Codes, IndexedCodes],
+           abund_detect: float = c_epsilon,
+           abund_nondetect: float = c_epsilon,
+           meta_mode: str = "off") -> Hits:
+    """ compare in-memory codes (or IndexedCodes read from a binary codes file) to a loaded table """
+    if meta_mode != "off":
+        abund_detect, abund_nondetect = meta_settings(meta_mode, decoding=True)[:2]
+    return decode_all(
+        table_to_sfv(table, abund_nondetect),
+        sample_codes,
+        abund_detect=abund_detect,
+    )
+
+
+def decode_thresholds(table: Table,
+                      sample_codes: Codes,
+                      thresholds: List[float],
+                      abund_nondetect: float = c_epsilon,
+                      meta_mode: str = "off") -> Dict[float, Dict[str, int]]:
+    """ check_hits counts of in-memory codes against a loaded table for each abund_detect threshold """
+    if meta_mode != "off":
+        abund_nondetect = meta_settings(meta_mode, decoding=True)[1]
+    coded, minimum = code_min_abundance(table, sample_codes, abund_nondetect)
+    return threshold_confusions(sample_codes, table.samples, coded, minimum, thresholds)
+
+
+def update(old_table: Table,
+           new_table: Table,
+           sample_codes: Codes,
+           abund_detect: float = c_epsilon,
+           abund_nondetect: float = c_epsilon,
+           similarity_cutoff: Optional[float] = None,
+           min_code_size: int = 1,
+           ranking: str = "rarity",
+           engine: str = "sets",
+           jaccard_index: str = "exact",
+           jobs: int = 1,
+           meta_mode: str = "off") -> Codes:
+    """ codes for old_table with the samples of new_table added, given the codes of old_table """
+    if meta_mode != "off":
+        abund_detect, abund_nondetect, similarity_cutoff, min_code_size, ranking = \
+            meta_settings(meta_mode, decoding=False)
+    return update_all(
+        table_to_sfv(old_table, abund_nondetect),
+        table_to_sfv(merge_tables(old_table, new_table), abund_nondetect),
+        sample_codes,
+        abund_detect=abund_detect,
+        abund_nondetect=abund_nondetect,
+        similarity_cutoff=similarity_cutoff,
+        min_code_size=min_code_size,
+        ranking=ranking,
+        engine=engine,
+        jaccard_index=jaccard_index,
+        jobs=jobs,
+    )
 
 
 # ---------------------------------------------------------------
@@ -464,58 +1769,110 @@ def run_idability(input_args):
     args = parser.parse_args(input_args)
     table_path = args.table
     codes_path = args.codes
-    abund_detect = args.abund_detect
-    abund_nondetect = args.abund_nondetect
-    similarity_cutoff = args.jaccard_similarity_cutoff
-    min_code_size = args.min_code_size
-    ranking = args.ranking
     output_path = args.output
 
-    # overrides
-    if args.meta_mode != "off":
-        choice = args.meta_mode
-        abund_detect = c_rpkm_detect if choice == "rpkm" else c_relab_detect
-        abund_nondetect = abund_detect * c_nondetect_multiplier
-        # relax detection parameter in decoding step
-        abund_detect = (abund_detect * c_relax_multiplier) if args.codes is not None else abund_detect
-        similarity_cutoff = c_max_jaccard
-        min_code_size = c_min_code_size
-        ranking = "abundance_gap"
+    if args.update_codes is not None and args.old_table is None:
+        parser.error("--update_codes requires --old_table")
 
     # determine output file name
     if output_path is None:
         items = [map_path_name(table_path)]
-        if codes_path is None:
+        if args.update_codes is not None:
+            items = [map_path_name(args.update_codes), "updated", c_codes_extension]
+        elif codes_path is None:
             items.append(c_codes_extension)
         else:
             items.append(map_path_name(codes_path))
-            items.append(c_hits_extension)
+            items.append(c_hits_extension if args.detect_thresholds is None else c_thresholds_extension)
         output_path = ".".join(items)
 
+    if args.profile or args.metrics_out is not None:
+        start_metrics()
+
     # do this for either encoding/decoding
     print("loading table file:", table_path)
-    sfv = load_sfv(table_path, abund_nondetect)
+    table = load_table(table_path, cache=not args.no_table_cache)
+    if args.rank is not None:
+        print("summing features up to rank:", args.rank)
+        table = rollup_table(table, args.rank)
+    record_counts(samples=len(table.samples), features=len(table.features), nnz=len(table.data))
+
+    # add samples to existing codes mode
+    if args.update_codes is not None:
+        print("loading old table file:", args.old_table)
+        old_table = load_table(args.old_table, cache=not args.no_table_cache)
+        if args.rank is not None:
+            old_table = rollup_table(old_table, args.rank)
+        print("updating the codes:", args.update_codes)
+        sample_codes = update(
+            old_table,
+            table,
+            read_codes(args.update_codes),
+            abund_detect=args.abund_detect,
+            abund_nondetect=args.abund_nondetect,
+            similarity_cutoff=args.jaccard_similarity_cutoff,
+            min_code_size=args.min_code_size,
+            ranking=args.ranking,
+            engine=args.engine,
+            jaccard_index=args.jaccard_index,
+            jobs=args.jobs,
+            meta_mode=args.meta_mode,
+        )
+        write_codes(sample_codes, output_path)
 
     # make codes mode
-    if codes_path is None:
+    elif codes_path is None:
         print("encoding the table:", table_path)
-        sample_codes = encode_all(
-            sfv,
-            abund_detect=abund_detect,
-            abund_nondetect=abund_nondetect,
-            similarity_cutoff=similarity_cutoff,
-            min_code_size=min_code_size,
-            ranking=ranking,
+        sample_codes = encode(
+            table,
+            abund_detect=args.abund_detect,
+            abund_nondetect=args.abund_nondetect,
+            similarity_cutoff=args.jaccard_similarity_cutoff,
+            min_code_size=args.min_code_size,
+            ranking=args.ranking,
+            engine=args.engine,
+            jaccard_index=args.jaccard_index,
+            jobs=args.jobs,
+            meta_mode=args.meta_mode,
         )
         write_codes(sample_codes, output_path)
 
+    # compare codes to table at several thresholds mode
+    elif args.detect_thresholds is not None:
+        print("decoding the table at %d thresholds:" % len(args.detect_thresholds), table_path)
+        sample_codes = read_codes(codes_path)
+        confusions = decode_thresholds(
+            table,
+            sample_codes,
+            args.detect_thresholds,
+            abund_nondetect=args.abund_nondetect,
+            meta_mode=args.meta_mode,
+        )
+        write_thresholds(confusions, output_path)
+
     # compare codes to table mode
     else:
         print("decoding the table:", table_path)
-        sample_codes = read_codes(codes_path)
-        sample_hits = decode_all(
-            sfv,  # input file
+        # binary codes are decoded in their integer form
+        sample_codes = read_indexed_codes(codes_path) if is_binary_codes(codes_path) else read_codes(codes_path)
+        sample_hits = decode(
+            table,  # input file
             sample_codes,  # codes to compare
-            abund_detect=abund_detect,
+            abund_detect=args.abund_detect,
+            abund_nondetect=args.abund_nondetect,
+            meta_mode=args.meta_mode,
         )
         write_hits(sample_hits, sample_codes, output_path)
+
+    if metrics["enabled"]:
+        if isinstance(sample_codes, IndexedCodes):
+            code_lengths = np.diff(sample_codes.offsets)[~sample_codes.missing].tolist()
+        else:
+            code_lengths = [len(code) for code in sample_codes.values() if code is not None]
+        record_counts(codes=len(code_lengths),
+                      average_code_length=float(np.mean(code_lengths)) if code_lengths else 0.0)
+        write_metrics(stop_metrics(), "-" if args.metrics_out is None else args.metrics_out)
+
+
+if __name__ == "__main__":
+    run_idability(sys.argv[1:])
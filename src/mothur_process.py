@@ -54,7 +54,12 @@ def check_file(input_dir: str, file: str) -> bool:
         return False
 
 
-def run_mothur(input_dir: str, output_dir: str, rerun: bool = False, reclassify: bool = False) -> None:
+def run_mothur(input_dir: str, output_dir: str, rerun: bool = False, reclassify: bool = False,
+               gz: bool = False) -> None:
+    """
+    Runs the mothur pipeline on the sequence files of a visit folder
+    :param gz: use the .fastq.gz files of the folder as input instead of uncompressed .fastq files
+    """
     input_dir = os.path.join(ROOT, input_dir)
     output_dir = os.path.join(ROOT, output_dir)
 
@@ -74,7 +79,8 @@ def run_mothur(input_dir: str, output_dir: str, rerun: bool = False, reclassify:
         print("\nRerunning mothur, will create files even if already exists.")
 
     if not check_file(input_dir, f"{prefix}.files") or rerun:
-        m.make.file(inputdir=input_dir, type=config["data_type"], prefix=prefix)
+        # make.file takes gz for gzip compressed fastq files
+        m.make.file(inputdir=input_dir, type="gz" if gz else config["data_type"], prefix=prefix)
 
     if not check_file(input_dir, f"{prefix}.trim.contigs.fasta") or rerun:
         m.make.contigs(file=f"{prefix}.files", processors=processors, inputdir=input_dir)
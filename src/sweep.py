@@ -0,0 +1,315 @@
+import itertools
+import multiprocessing
+import os
+import re
+
+import pandas as pd
+
+from src.idability import *
+
+"""
+Parameter sweeps and visit x visit matrices for idability that load every table once and reuse intermediate results
+"""
+
+# parameters of one sweep combination, in the order of the results table
+SWEEP_PARAMETERS = ["abund_detect", "abund_nondetect", "similarity_cutoff", "min_code_size", "ranking", "rank"]
+
+
+class SweepCache:
+    """
+    Intermediate idability results of a sweep. Every result is keyed by the table and
+    only the parameters it depends on, e.g. rankings by (table, abund_nondetect, ranking).
+    """
+
+    def __init__(self, table_paths: dict, engine: str = "sets", jaccard_index: str = "exact", jobs: int = 1):
+        self.table_paths = table_paths
+        self.engine = engine
+        self.jaccard_index = jaccard_index
+        self.jobs = jobs
+        self.results = {}
+
+    def get(self, key: tuple, compute):
+        if key not in self.results:
+            self.results[key] = compute()
+        return self.results[key]
+
+    def table(self, name: str, rank: str = None) -> Table:
+        if rank is None:
+            return self.get(("table", name), lambda: load_table(self.table_paths[name]))
+        return self.get(("table", name, rank), lambda: rollup_table(self.table(name), rank, self.lineages(name)))
+
+    def lineages(self, name: str) -> Lineages:
+        return self.get(("lineages", name), lambda: lineage_tree(self.table(name).features))
+
+    def sfv(self, name: str, abund_nondetect: float, rank: str = None) -> dict:
+        return self.get(("sfv", name, abund_nondetect, rank),
+                        lambda: table_to_sfv(self.table(name, rank), abund_nondetect))
+
+    def fsv(self, name: str, abund_nondetect: float, rank: str = None) -> dict:
+        return self.get(("fsv", name, abund_nondetect, rank),
+                        lambda: flip_sfv(self.sfv(name, abund_nondetect, rank)))
+
+    def fsv_sets(self, name: str, abund_nondetect: float, rank: str = None) -> dict:
+        return self.get(("fsv_sets", name, abund_nondetect, rank),
+                        lambda: coerce_to_sets(self.fsv(name, abund_nondetect, rank)))
+
+    def sfv_sets(self, name: str, abund_nondetect: float, abund_detect: float, rank: str = None) -> dict:
+        return self.get(("sfv_sets", name, abund_nondetect, abund_detect, rank),
+                        lambda: coerce_to_sets(reduce_sfv(self.sfv(name, abund_nondetect, rank), abund_detect)))
+
+    def rankings(self, name: str, abund_nondetect: float, ranking: str, rank: str = None) -> dict:
+        """
+        rankings of all features above abund_nondetect; both rankings are stable sorts with
+        keys that do not depend on abund_detect, so they are filtered per abund_detect later
+        """
+        rank_function = {"rarity": rank_by_rarity, "abundance_gap": rank_by_abundgap}[ranking]
+        return self.get(("rankings", name, abund_nondetect, ranking, rank),
+                        lambda: rank_function(self.sfv(name, abund_nondetect, rank),
+                                              self.fsv(name, abund_nondetect, rank), abund_nondetect))
+
+    def similar_features(self, name: str, abund_nondetect: float, similarity_cutoff: float, rank: str = None) -> dict:
+        return self.get(("similar_features", name, abund_nondetect, similarity_cutoff, rank),
+                        lambda: similarity_index(self.fsv_sets(name, abund_nondetect, rank), similarity_cutoff,
+                                                 method=self.jaccard_index))
+
+    def codes(self, name: str, abund_detect: float, abund_nondetect: float, similarity_cutoff, min_code_size: int,
+              ranking: str, rank: str = None) -> dict:
+        def compute():
+            sfv_sets = self.sfv_sets(name, abund_nondetect, abund_detect, rank)
+            rankings = self.rankings(name, abund_nondetect, ranking, rank)
+            sorted_features = {sample: [feature for feature in rankings[sample] if feature in features_set]
+                               for sample, features_set in sfv_sets.items()}
+            similar_features = None
+            if similarity_cutoff is not None:
+                similar_features = self.similar_features(name, abund_nondetect, similarity_cutoff, rank)
+            return make_all_codes(sorted_features, sfv_sets, self.fsv_sets(name, abund_nondetect, rank),
+                                  similarity_cutoff, min_code_size, similar_features,
+                                  engine=self.engine, jobs=self.jobs)
+
+        return self.get(("codes", name, abund_detect, abund_nondetect, similarity_cutoff, min_code_size, ranking,
+                         rank), compute)
+
+    def postings(self, name: str, abund_nondetect: float, abund_detect: float, rank: str = None) -> dict:
+        return self.get(("postings", name, abund_nondetect, abund_detect, rank),
+                        lambda: build_postings(self.sfv_sets(name, abund_nondetect, abund_detect, rank)))
+
+    def hits(self, name: str, sample_codes: dict, abund_nondetect: float, abund_detect: float,
+             rank: str = None) -> HitMatrix:
+        table_samples = list(self.sfv_sets(name, abund_nondetect, abund_detect, rank))
+        return decode_matrix(sample_codes, self.postings(name, abund_nondetect, abund_detect, rank), table_samples)
+
+
+def visit_number(visit: str) -> int:
+    """
+    Number of a visit name like visit10, used to sort visits
+    """
+    digits = re.sub(r"\D", "", visit)
+    return int(digits) if digits else 0
+
+
+def visit_tables(data_dir: str) -> dict:
+    """
+    Finds the table of each visit in a folder with files named like otus-<body-site_study-name>-<rdp>-<visit>.pcl
+    :param data_dir: folder with .pcl files
+    :return: dict of visit -> path, sorted by visit number
+    """
+    tables = {file[:-4].split("-")[-1]: os.path.join(data_dir, file)
+              for file in os.listdir(data_dir) if file.endswith(".pcl")}
+    return {visit: tables[visit] for visit in sorted(tables, key=visit_number)}
+
+
+def parse_pairs(pair_specs: list, visits: list) -> list:
+    """
+    Parses <code_visit>:<visit>,<visit> specifications, 'all' stands for every other visit
+    :param pair_specs: list of specifications
+    :param visits: all available visits
+    :return: list of (code visit, list of eval visits)
+    """
+    pairs = []
+    for spec in pair_specs:
+        code_visit, _, eval_spec = spec.partition(":")
+        if eval_spec in ("", "all"):
+            eval_visits = [visit for visit in visits if visit != code_visit]
+        else:
+            eval_visits = eval_spec.split(",")
+        for visit in [code_visit] + eval_visits:
+            if visit not in visits:
+                raise ValueError(f"No table found for {visit}, available visits: {', '.join(visits)}")
+        pairs.append((code_visit, eval_visits))
+    return pairs
+
+
+def parameter_grid(grid: dict) -> list:
+    """
+    Expands a dict of parameter -> list of values into all combinations
+    :param grid: values for each of SWEEP_PARAMETERS
+    :return: list of dicts, one per combination
+    """
+    return [dict(zip(SWEEP_PARAMETERS, values))
+            for values in itertools.product(*[grid[parameter] for parameter in SWEEP_PARAMETERS])]
+
+
+def run_sweep(table_paths: dict, pairs: list, grid: dict, engine: str = "sets", jaccard_index: str = "exact",
+              jobs: int = 1) -> pd.DataFrame:
+    """
+    Encodes and decodes every (code table, eval table) pair for every parameter combination
+    :param table_paths: table name -> .pcl path
+    :param pairs: list of (code table name, list of eval table names)
+    :param grid: parameter -> list of values, see SWEEP_PARAMETERS
+    :return: tidy DataFrame with one row per pair, eval table and combination and the check_hits counts
+    """
+    cache = SweepCache(table_paths, engine=engine, jaccard_index=jaccard_index, jobs=jobs)
+    rows = []
+    for parameters in parameter_grid(grid):
+        print("Sweeping", ", ".join(f"{key}={value}" for key, value in parameters.items()))
+        for code_name, eval_names in pairs:
+            sample_codes = cache.codes(code_name, **parameters)
+            for eval_name in eval_names:
+                hits = cache.hits(eval_name, sample_codes, parameters["abund_nondetect"], parameters["abund_detect"],
+                                  parameters["rank"])
+                confusion = hit_confusion(hits, sample_codes)
+                row = {"code_table": code_name, "eval_table": eval_name}
+                row.update(parameters)
+                row.update({key: confusion[key] for key in sorted(confusion)})
+                rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def write_sweep(results: pd.DataFrame, path: str) -> None:
+    """
+    Saves the sweep results as a .tsv file
+    """
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    results.to_csv(path, sep="\t", index=False)
+    print("wrote sweep results to:", path)
+
+
+# read-only decode state of a matrix worker process, inherited on fork or set once by init_matrix_worker
+matrix_state = {}
+
+
+def init_matrix_worker(state: dict) -> None:
+    """
+    Receives the decode state once per worker process
+    """
+    matrix_state.update(state)
+
+
+def decode_cell(cell: tuple) -> tuple:
+    """
+    Worker entry point: decodes the codes of one visit against the table of another visit
+    :param cell: (code visit, eval visit)
+    :return: (check_hits counts, check_hits counts of the samples in both visits)
+    """
+    code_visit, eval_visit = cell
+    sample_codes = matrix_state["codes"][code_visit]
+    postings, table_samples = matrix_state["populations"][eval_visit]
+    matrix = decode_matrix(sample_codes, postings, table_samples)
+    return hit_confusion(matrix, sample_codes), shared_confusion(matrix, sample_codes)
+
+
+def decode_cells(cells: list, state: dict, jobs: int) -> list:
+    """
+    Decodes all cells on a process pool, results come back in cell order
+    """
+    if jobs <= 1 or len(cells) <= 1:
+        matrix_state.update(state)
+        try:
+            return [decode_cell(cell) for cell in cells]
+        finally:
+            matrix_state.clear()
+    if "fork" in multiprocessing.get_all_start_methods():
+        # workers inherit codes and postings from this process, nothing is pickled per cell
+        context, initializer, initargs = multiprocessing.get_context("fork"), None, ()
+        matrix_state.update(state)
+    else:
+        context, initializer, initargs = multiprocessing.get_context(), init_matrix_worker, (state,)
+    try:
+        with context.Pool(min(jobs, len(cells)), initializer=initializer, initargs=initargs) as pool:
+            return pool.map(decode_cell, cells)
+    finally:
+        matrix_state.clear()
+
+
+def shared_confusion(matrix: HitMatrix, sample_codes: dict) -> dict:
+    """
+    check_hits counts of the samples that are also in the evaluated table. A subject missing from the
+    evaluated visit can not be hit, check_hits counts its code as FN.
+    """
+    table_samples = set(matrix.table_samples)
+    shared = np.array([sample in table_samples for sample in matrix.samples], dtype=bool)
+    counts = np.bincount(hit_classes(matrix, sample_codes)[shared], minlength=len(c_confusion_classes))
+    return dict(zip(c_confusion_classes, counts.tolist()))
+
+
+def coded_count(confusion: dict) -> int:
+    """
+    Number of samples with a code in check_hits counts
+    """
+    return confusion["1|TP"] + confusion["2|TP+FP"] + confusion["3|FN+FP"] + confusion["4|FN"]
+
+
+def confusion_rates(confusion: dict, shared: dict) -> dict:
+    """
+    Rates of the samples with a code in both visits: the code hits the same subject (TP),
+    another subject (FP) or misses the subject (FN); TP and FP can both happen for one code
+    :param confusion: check_hits counts
+    :param shared: check_hits counts of the samples in both visits
+    :return: dict with coded (samples with a code in both visits), absent (samples with a code missing from
+        the evaluated visit) and the rates
+    """
+    coded = coded_count(shared)
+    rates = {"coded": coded, "absent": coded_count(confusion) - coded}
+    if coded == 0:
+        rates.update({"tp_rate": float("nan"), "fp_rate": float("nan"), "fn_rate": float("nan")})
+        return rates
+    rates.update({
+        "tp_rate": (shared["1|TP"] + shared["2|TP+FP"]) / coded,
+        "fp_rate": (shared["2|TP+FP"] + shared["3|FN+FP"]) / coded,
+        "fn_rate": (shared["3|FN+FP"] + shared["4|FN"]) / coded,
+    })
+    return rates
+
+
+def run_matrix(table_paths: dict, parameters: dict, engine: str = "sets", jaccard_index: str = "exact",
+               jobs: int = 1) -> pd.DataFrame:
+    """
+    Encodes every visit and decodes its codes against every other visit. Each table is loaded,
+    encoded and indexed once, the decodes run in parallel
+    :param table_paths: visit -> .pcl path
+    :param parameters: one value for each of SWEEP_PARAMETERS
+    :return: tidy DataFrame with one row per (code visit, eval visit), the check_hits counts and rates
+    """
+    cache = SweepCache(table_paths, engine=engine, jaccard_index=jaccard_index, jobs=jobs)
+    visits = list(table_paths)
+    state = {"codes": {}, "populations": {}}
+    for visit in visits:
+        print("Creating code for :", visit)
+        state["codes"][visit] = cache.codes(visit, **parameters)
+        population = (visit, parameters["abund_nondetect"], parameters["abund_detect"], parameters["rank"])
+        state["populations"][visit] = (cache.postings(*population), list(cache.sfv_sets(*population)))
+    cells = [(code_visit, eval_visit) for code_visit in visits for eval_visit in visits if code_visit != eval_visit]
+    print(f"Decoding {len(cells)} visit pairs with {jobs} processes")
+    rows = []
+    for (code_visit, eval_visit), (confusion, shared) in zip(cells, decode_cells(cells, state, jobs)):
+        row = {"code_visit": code_visit, "eval_visit": eval_visit}
+        row.update({key: confusion[key] for key in sorted(confusion)})
+        row.update(confusion_rates(confusion, shared))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def write_matrix(results: pd.DataFrame, output_dir: str) -> None:
+    """
+    Saves the counts of every visit pair and one code visit x eval visit matrix per rate as .tsv files
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    results.to_csv(os.path.join(output_dir, "counts.tsv"), sep="\t", index=False)
+    visits = list(dict.fromkeys(results["code_visit"].tolist() + results["eval_visit"].tolist()))
+    for rate in ["tp_rate", "fp_rate", "fn_rate"]:
+        matrix = results.pivot(index="code_visit", columns="eval_visit", values=rate).reindex(index=visits,
+                                                                                            columns=visits)
+        matrix.to_csv(os.path.join(output_dir, rate + ".tsv"), sep="\t")
+    print("wrote idability matrix to:", output_dir)
@@ -1,43 +1,201 @@
-import gzip
+import functools
+import json
+import multiprocessing
 import os
 import shutil
+import tarfile
+import time
 import zipfile
+import zlib
 
 """
 File containing utility functions for creating and modifing datasets
 """
 
+# bytes copied from a decoder to a file at a time
+COPY_BUFFER_SIZE = 1 << 20
+# extensions of the downloaded archives that are decompressed
+ARCHIVE_EXTENSIONS = (".tar", ".gz")
+# suffix of the file (.<archive>.extracted) recording which version of an archive was extracted
+EXTRACTED_SUFFIX = ".extracted"
 
-def unpack_tar(body_folder: str) -> None:
+
+def gunzip_stream(fh, f_out) -> None:
     """
-    Unpacks .tar files to the folder
-    :param body_folder: Folder with .tar files
+    Decompresses a .gz stream (one or more gzip members) to f_out. Unlike gzip.GzipFile, the stream is read in
+    chunks of COPY_BUFFER_SIZE, which matters when it is a member of a .tar stream.
     """
-    for visit in os.listdir(body_folder):
-        for file in os.listdir(os.path.join(body_folder, visit)):
-            current_file = os.path.join(body_folder, visit, file)
-            destination = os.path.join(body_folder, visit)
-            if file.endswith(".tar"):
-                os.system(f"tar -xvf {current_file} -C {destination}")
-                print("Unpacked file:", file)
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)  # gzip header and trailer
+    pending = False
+    for data in iter(lambda: fh.read(COPY_BUFFER_SIZE), b""):
+        while data:
+            if not pending:
+                data = data.lstrip(b"\0")  # zero padding between or after members
+                if not data:
+                    break
+            f_out.write(decompressor.decompress(data))
+            pending = not decompressor.eof
+            if pending:
+                break
+            # the rest belongs to the next member
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    if pending:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+
+def write_stream(fh, path: str, gunzip: bool = True) -> str:
+    """
+    Saves a stream to path, .gz streams are decompressed to path without .gz unless gunzip is False
+    :return: path of the saved file
+    """
+    gunzip = gunzip and path.endswith(".gz")
+    with open(path[:-3] if gunzip else path, "wb") as f_out:
+        if gunzip:
+            gunzip_stream(fh, f_out)
+        else:
+            shutil.copyfileobj(fh, f_out, COPY_BUFFER_SIZE)
+    return f_out.name
 
 
-def unpack_gz(body_folder: str) -> None:
+def extract_stream(fh, name: str, destination: str, gunzip: bool = True) -> list:
     """
-    Unpacks .gz files to the folder
-    :param body_folder: Folder with .gz files
+    Extracts an archive read from a stream into a folder without saving the archive.
+    Files in .tar archives are unpacked and decompressed if they end with .gz, like running unpack_tar and
+    unpack_gz. Other .gz files are decompressed and all other files are copied.
+    :param fh: readable stream, e.g. the body of a download
+    :param name: file name of the archive
+    :param destination: folder to extract the files to
+    :param gunzip: if False, .gz files are saved compressed (e.g. .fastq.gz files for mothur)
+    :return: paths of the extracted files
     """
-    for visit in os.listdir(body_folder):
-        for file in os.listdir(os.path.join(body_folder, visit)):
-            current_file = os.path.join(body_folder, visit, file)
+    if not name.endswith(".tar"):
+        return [write_stream(fh, os.path.join(destination, name), gunzip)]
+
+    extracted = []
+    with tarfile.open(fileobj=fh, mode="r|*") as tar:
+        for member in tar:
+            path = os.path.normpath(member.name)
+            if os.path.isabs(path) or path.split(os.sep)[0] == os.pardir:
+                raise tarfile.TarError(f"unsafe path in archive {name}: {member.name}")
+            if member.isdir():
+                os.makedirs(os.path.join(destination, path), exist_ok=True)
+            elif member.isfile():
+                os.makedirs(os.path.dirname(os.path.join(destination, path)), exist_ok=True)
+                extracted.append(write_stream(tar.extractfile(member), os.path.join(destination, path), gunzip))
+    return extracted
+
+
+def move_files(source: str, destination: str) -> None:
+    """
+    Moves all files of a folder and its subfolders into destination, keeping the folder structure
+    """
+    for root, dirs, files in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(root, source))
+        os.makedirs(target, exist_ok=True)
+        for file in files:
+            os.replace(os.path.join(root, file), os.path.join(target, file))
+
+
+def find_archives(data_dir: str, keep_gz: bool = False) -> list:
+    """
+    Paths of all .tar and .gz files in the visit folders <data_dir>/<body_site>_<study_name>/<visit>
+    :param keep_gz: only find .tar files
+    """
+    extensions = (".tar",) if keep_gz else ARCHIVE_EXTENSIONS
+    archives = []
+    for body_study in sorted(os.listdir(data_dir)):
+        body_folder = os.path.join(data_dir, body_study)
+        if os.path.isdir(body_folder):
+            for visit in sorted(os.listdir(body_folder)):
+                visit_folder = os.path.join(body_folder, visit)
+                if os.path.isdir(visit_folder):
+                    archives += [os.path.join(visit_folder, file) for file in sorted(os.listdir(visit_folder))
+                                 if file.endswith(extensions)]
+    return archives
+
+
+def archive_stamp(path: str) -> list:
+    """
+    Size and modification time identifying the current version of an archive
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def decompress_archive(path: str, keep_gz: bool = False) -> dict:
+    """
+    Extracts a .tar or .gz file into its folder with extract_stream, unless the same version of the archive
+    (size and mtime) was extracted before in the same way and its files still exist
+    :param keep_gz: save the .gz files of a .tar compressed
+    :return: dict with path, bytes (size of the archive), extracted (size of the extracted files), status
+        ("ok", "skipped" or "failed") and error
+    """
+    folder, name = os.path.split(path)
+    stamp_path = os.path.join(folder, f".{name}{EXTRACTED_SUFFIX}")
+    stamp = archive_stamp(path)
+    if os.path.exists(stamp_path):
+        with open(stamp_path) as fh:
+            record = json.load(fh)
+        if record["stamp"] == stamp and record.get("keep_gz", False) == keep_gz \
+                and all(os.path.exists(os.path.join(folder, file)) for file in record["files"]):
+            return {"path": path, "bytes": 0, "extracted": 0, "status": "skipped", "error": None}
+
+    # files are extracted to a staging folder first, so a failed archive leaves no partial files
+    staging = os.path.join(folder, f".{name}.part")
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    try:
+        with open(path, "rb", buffering=COPY_BUFFER_SIZE) as fh:
+            files = [os.path.relpath(file, staging) for file in extract_stream(fh, name, staging, not keep_gz)]
+        extracted = sum(os.path.getsize(os.path.join(staging, file)) for file in files)
+        move_files(staging, folder)
+    except (OSError, EOFError, tarfile.TarError, zlib.error) as e:
+        return {"path": path, "bytes": 0, "extracted": 0, "status": "failed", "error": f"{type(e).__name__}: {e}"}
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    with open(stamp_path, "w") as fh:
+        json.dump({"stamp": stamp, "keep_gz": keep_gz, "files": files}, fh)
+    return {"path": path, "bytes": stamp[0], "extracted": extracted, "status": "ok", "error": None}
+
+
+def decompress_all(data_dir: str, jobs: int = 1, keep_gz: bool = False) -> list:
+    """
+    Extracts all .tar and .gz files of all visit folders on a process pool
+    :param data_dir: folder with downloaded files
+    :param jobs: number of processes
+    :param keep_gz: only unpack .tar files and keep the .gz files compressed
+    :return: list of decompress_archive results
+    """
+    archives = find_archives(data_dir, keep_gz)
+    print(f"Extracting {len(archives)} files with {jobs} processes")
+    start = time.perf_counter()
+    results = []
+
+    def report(result):
+        results.append(result)
+        if result["status"] == "ok":
+            print(f"[{len(results)}/{len(archives)}] Unpacked file:", result["path"])
+        elif result["status"] == "skipped":
+            print(f"[{len(results)}/{len(archives)}] Already unpacked:", result["path"])
+        else:
+            print(f"[{len(results)}/{len(archives)}] Failed to unpack {result['path']}:", result["error"])
+
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            for result in pool.imap_unordered(functools.partial(decompress_archive, keep_gz=keep_gz), archives):
+                report(result)
+    else:
+        for archive in archives:
+            report(decompress_archive(archive, keep_gz))
 
-            if file.endswith(".gz"):
-                with gzip.open(current_file, 'rb') as f_in:
-                    with open(current_file[:-3], 'wb') as f_out:
-                        print(f"fin: {f_in}")
-                        print(f"fout: {f_out}")
-                        shutil.copyfileobj(f_in, f_out)
-                print("Unpacked file:", file)
+    seconds = time.perf_counter() - start
+    read = sum(result["bytes"] for result in results) / 2 ** 20
+    written = sum(result["extracted"] for result in results) / 2 ** 20
+    skipped = sum(result["status"] == "skipped" for result in results)
+    print(f"Extracted {read:.1f} MB into {written:.1f} MB in {seconds:.1f} s ({read / max(seconds, 1e-9):.1f} MB/s "
+          f"read, {written / max(seconds, 1e-9):.1f} MB/s written), {skipped} files were already extracted")
+    return results
 
 
 def unpack_zip(file_path: str) -> None:
@@ -49,20 +207,22 @@ def unpack_zip(file_path: str) -> None:
     print("Unpacked file:", file_path)
 
 
-def clean_folder(body_folder: str) -> None:
+def clean_folder(body_folder: str, keep_gz: bool = False) -> None:
     """
     Removes all files in the data folder
+    :param keep_gz: only remove .tar files and keep the .gz files
     """
+    extensions = (".tar", EXTRACTED_SUFFIX) if keep_gz else (".gz", ".tar", EXTRACTED_SUFFIX)
     count = 0
     for visit in os.listdir(body_folder):
         for file in os.listdir(os.path.join(body_folder, visit)):
             current_file = os.path.join(body_folder, visit, file)
 
-            if current_file.endswith(".gz") or current_file.endswith(".tar"):
+            if current_file.endswith(extensions):
                 os.remove(current_file)
                 count = count + 1
 
-    print(f"Removed .tar and .gz files from {body_folder}, total of {count} files.")
+    print(f"Removed {'.tar' if keep_gz else '.tar and .gz'} files from {body_folder}, total of {count} files.")
 
 
 def check_os():
@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+import pytest
+
+import src.idability
+from src.bootstrap import mask_table
+from src.idability import *
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+BUCCAL_VISIT1 = os.path.join(ROOT, "processed_data", "final_data_low", "buccal_mucosa_momspi", "rdp18",
+                             "otus-buccal_mucosa_momspi-rdp18-visit1.pcl")
+FECES_NO_SAMPLES = os.path.join(ROOT, "processed_data", "double_visits", "rdp6", "otus-feces_momspi-rdp6-visit1.pcl")
+
+
+def split_table(table: Table, seed: int, fraction: float = 0.8) -> tuple:
+    """
+    Random split of the samples of a table into an old and a new table
+    """
+    old = np.random.RandomState(seed).rand(len(table.samples)) < fraction
+    features = np.ones(len(table.features), dtype=bool)
+    return mask_table(table, old, features), mask_table(table, ~old, features)
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+@pytest.mark.parametrize("similarity_cutoff, min_code_size, ranking", [
+    (None, 1, "rarity"),
+    (c_max_jaccard, 1, "rarity"),
+    (c_max_jaccard, 3, "abundance_gap"),
+    (None, 5, "rarity"),
+])
+def test_update_matches_encode_of_merged_table(seed, similarity_cutoff, min_code_size, ranking):
+    old_table, new_table = split_table(load_table(BUCCAL_VISIT1, cache=False), seed)
+    parameters = dict(abund_detect=c_relab_detect, abund_nondetect=c_relab_detect * c_nondetect_multiplier,
+                      similarity_cutoff=similarity_cutoff, min_code_size=min_code_size, ranking=ranking)
+    updated = update(old_table, new_table, encode(old_table, **parameters), **parameters)
+    assert dict(updated) == dict(encode(merge_tables(old_table, new_table), **parameters))
+
+
+def truncate_cache(cache_path):
+    with open(cache_path, "rb") as fh:
+        data = fh.read()
+    with open(cache_path, "wb") as fh:
+        fh.write(data[:len(data) // 2])
+
+
+def overwrite_cache(cache_path):
+    with open(cache_path, "wb") as fh:
+        fh.write(b"not a numpy file")
+
+
+def drop_cache_array(cache_path):
+    with np.load(cache_path) as npz:
+        arrays = {key: npz[key] for key in npz.files if key != "data"}
+    np.savez(cache_path, **arrays)
+
+
+@pytest.mark.parametrize("corrupt", [truncate_cache, overwrite_cache, drop_cache_array])
+def test_load_table_rebuilds_unreadable_cache(tmp_path, corrupt):
+    path = str(tmp_path / "table.pcl")
+    with open(BUCCAL_VISIT1) as source, open(path, "w") as fh:
+        fh.write(source.read())
+    table = load_table(path)
+    corrupt("%s.%s" % (path, c_table_cache_extension))
+    # the first load parses the table again, the second one reads the rebuilt cache
+    for loaded in (load_table(path), load_table(path)):
+        assert loaded.features == table.features and loaded.samples == table.samples
+        assert np.array_equal(loaded.indptr, table.indptr) and np.array_equal(loaded.data, table.data)
+
+
+def test_parse_table_quoted_without_samples():
+    table = parse_table(FECES_NO_SAMPLES)
+    assert table.samples == []
+    assert len(table.features) > 0
+    assert load_sfv(FECES_NO_SAMPLES, c_relab_detect, cache=False) == {}
+
+
+def test_parse_table_quoted_matches_unquoted(tmp_path):
+    (tmp_path / "plain.pcl").write_text("subject_id\tS1\tS2\nRoot;Bacteria\t0.5\t0\nRoot;Archaea\t0\t0.25\n")
+    (tmp_path / "quoted.pcl").write_text('subject_id\tS1\tS2\n"Root;Bacteria"\t0.5\t0\n"Root;Archaea"\t0\t0.25\n')
+    plain, quoted = parse_table(str(tmp_path / "plain.pcl")), parse_table(str(tmp_path / "quoted.pcl"))
+    assert plain.features == quoted.features == ["Root;Bacteria", "Root;Archaea"]
+    assert plain.samples == quoted.samples == ["S1", "S2"]
+    assert table_to_sfv(plain, 0) == table_to_sfv(quoted, 0)
+
+
+@pytest.mark.parametrize("min_code_size", [1, 7])
+def test_decode_indexed_codes_matches_codes(min_code_size):
+    table = load_table(BUCCAL_VISIT1, cache=False)
+    sample_codes = encode(table, abund_detect=c_relab_detect, abund_nondetect=c_relab_detect * c_nondetect_multiplier,
+                          min_code_size=min_code_size)
+    indexed_codes = index_codes(sample_codes)
+    sample_hits = decode(table, sample_codes, abund_detect=c_relab_detect)
+    assert decode(table, indexed_codes, abund_detect=c_relab_detect) == sample_hits
+    assert check_hits(sample_hits, indexed_codes) == check_hits(sample_hits, sample_codes)
+
+
+@pytest.mark.parametrize("similarity_cutoff", [0.0, 0.3, 0.8, 1.0])
+def test_similarity_index_matches_jaccard(monkeypatch, similarity_cutoff):
+    # small blocks and chunks, so features are spread over many of them
+    monkeypatch.setattr(src.idability, "c_similarity_block", 7)
+    monkeypatch.setattr(src.idability, "c_minhash_chunk", 50)
+    table = load_table(BUCCAL_VISIT1, cache=False)
+    fsv_sets = prepare_encode_table(table, c_relab_detect, c_relab_detect * c_nondetect_multiplier, None)[2]
+    features = list(fsv_sets)[:150]
+    fsv_sets = {feature: fsv_sets[feature] for feature in features}
+    expected = {feature: {feature2 for feature2 in features
+                          if jaccard(fsv_sets[feature], fsv_sets[feature2]) >= similarity_cutoff}
+                for feature in features}
+    assert similarity_index(fsv_sets, similarity_cutoff, method="exact") == expected
+    approximate = similarity_index(fsv_sets, similarity_cutoff, method="minhash")
+    assert all(approximate[feature] <= expected[feature] for feature in features)